@@ -41,3 +41,16 @@ def getAudioLibrosa(filename):
     XAudio = librosa.core.to_mono(XAudio)
     return (XAudio, Fs)
 
+
+def getAudioDuration(filename):
+    """
+    Use librosa to look up the duration of an audio file
+    without decoding all of it
+    :param filename: Path to audio file
+    :return: Duration in seconds, or None if it can't be determined
+    """
+    try:
+        import librosa
+        return librosa.get_duration(filename=filename)
+    except Exception:
+        return None
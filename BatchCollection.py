@@ -7,27 +7,396 @@ Used for Covers80, Covers1000, and MIREX
 import numpy as np
 import scipy.io as sio
 import os
+import re
 from BlockWindowFeatures import *
 from Chroma import *
 from MFCC import *
 from Onsets import *
 from AudioIO import *
 from EvalStatistics import *
+from FeatureStore import *
+from FeatureCache import *
+from JobQueue import *
 import SequenceAlignment._SequenceAlignment as SAC
 from sys import stdout
+from multiprocessing import Pool as PPool
 import time
 
+#Memory used by a worker process before it loads anything, in bytes
+WORKER_BASE_BYTES = 300e6
+#Bytes per element of the arrays in feature .mat files, by class
+MAT_CLASS_BYTES = {'double':8, 'single':4, 'int64':8, 'uint64':8, 'int32':4, 'uint32':4,
+                   'int16':2, 'uint16':2, 'int8':1, 'uint8':1, 'logical':1}
+#Number of nearest neighbors in the S matrices of early fusion
+BATCH_FUSION_K = 20
+#Entries kept in each row of the sparse early fusion engine.  Without
+#a limit, the diffused matrices fill in and the sparse engine does
+#dense work more slowly than the dense engine
+BATCH_FUSION_KEEP_K = 100
+#Bytes of score matrix rows to copy at once when growing scores
+SCORE_CHUNK_BYTES = 256e6
+
 def getMatFilename(scratchDir, filename):
     prefix = filename.split("/")[-1]
     prefix = prefix[0:-4]
     return "%s/%s.mat"%(scratchDir, prefix)
 
+def getBatchFeatures(scratchDir, filename):
+    """
+    Load the precomputed features of a song, preferably as
+    zero-copy views into the packed feature store if it exists,
+    or otherwise from the song's .mat file
+    :param scratchDir: Path to directory holding the features
+    :param filename: Path to the .mat file of features for the song
+    :returns Features: Dictionary of features, with 1x1 arrays
+        unpacked into scalars
+    """
+    Store = openFeatureStore(scratchDir)
+    if Store is not None:
+        Features = getStoreFeatures(Store, filename)
+        if Features is not None:
+            return Features
+    Features = sio.loadmat(filename)
+    for key, val in Features.items():
+        if type(val) is np.ndarray:
+            if val.size == 1:
+                Features[key] = val.flatten()[0]
+    return Features
+
+#Options in BlockParams that don't affect the results of a block
+BlockParamsNoTag = ['FeatureFiles', 'JournalInterval']
+
+def getBatchBlockFilename(scratchDir, idxs, Kappa, CSMTypes, BlockParams):
+    """
+    Return the path to which to save the results of a block.  If
+    the features come from the content-addressed feature cache, or if
+    any options that change the scores are set, the name also includes
+    a hash of the comparison parameters (and of the feature files in
+    the block, if they're known), so that a scratch directory can be
+    shared between experiments without reusing stale blocks
+    """
+    prefix = "%s/D%i_%i_%i_%i"%(scratchDir, idxs[0], idxs[1], idxs[2], idxs[3])
+    #Options that change the scores also need to change the name
+    Options = {}
+    for key in BlockParams:
+        if not key in BlockParamsNoTag:
+            Options[key] = BlockParams[key]
+    if not 'FeatureFiles' in BlockParams and len(Options) == 0:
+        return "%s.mat"%prefix
+    TagParams = {'Kappa':Kappa, 'CSMTypes':CSMTypes}
+    if 'FeatureFiles' in BlockParams:
+        FeatureFiles = BlockParams['FeatureFiles']
+        files = FeatureFiles[idxs[0]:idxs[1]] + FeatureFiles[idxs[2]:idxs[3]]
+        TagParams['files'] = [os.path.basename(f) for f in files]
+    if len(Options) > 0:
+        TagParams['Options'] = Options
+    tag = getFeatureParamsHash(TagParams)
+    return "%s_%s.mat"%(prefix, tag[0:12])
+
+def saveBatchW(ret, key, W, FeatureParams):
+    """
+    Store the W matrix for the SSM part of similarity fusion, either
+    densely, or, if FeatureParams['SparseWNeighbors'] is specified, as
+    a float32 nearest neighbor sparsified CSR matrix split into the
+    arrays key_data, key_indices, key_indptr, and key_shape
+    :param ret: Dictionary of features to save, updated in place
+    :param key: Name of the W matrix
+    :param W: Dense W matrix
+    :param FeatureParams: Dictionary of feature parameters
+    """
+    if not 'SparseWNeighbors' in FeatureParams or FeatureParams['SparseWNeighbors'] <= 0:
+        ret[key] = W
+        return
+    WS = sparsifyW(W, FeatureParams['SparseWNeighbors'])
+    ret['%s_data'%key] = WS.data
+    ret['%s_indices'%key] = np.array(WS.indices, dtype=np.int32)
+    ret['%s_indptr'%key] = np.array(WS.indptr, dtype=np.int32)
+    ret['%s_shape'%key] = np.array(WS.shape, dtype=np.int64)
+
+def getBatchW(Features, key):
+    """
+    Get a W matrix saved with saveBatchW out of a song's features
+    :param Features: Dictionary of features for a song
+    :param key: Name of the W matrix
+    :returns: The dense W matrix, or a sparse CSR matrix
+    """
+    if key in Features:
+        return Features[key]
+    [data, indices, indptr, shape] = [np.array(Features['%s_%s'%(key, s)]).flatten() for s in ['data', 'indices', 'indptr', 'shape']]
+    return sparse.csr_matrix((data, indices, indptr), shape=(int(shape[0]), int(shape[1])))
+
+def getBatchSSMNeighbors(Features, key, K):
+    """
+    Get the row sums and nearest neighbors of one of a song's SSM
+    affinity matrices (see getSSMNeighbors), computing them the first
+    time they're needed and keeping them with the song's features, so
+    that they're reused for every other song in the block
+    :param Features: Dictionary of precomputed features for a song
+    :param key: Name of the W matrix, e.g. 'WMFCCs0'
+    :param K: Number of nearest neighbors
+    """
+    NKey = ('SSMNeighbors', key, K)
+    if not NKey in Features:
+        Features[NKey] = getSSMNeighbors(getBatchW(Features, key), K)
+    return Features[NKey]
+
+def getBatchCSMFeatures(Features, key, dtype):
+    """
+    Get one of a song's features in the type in which Euclidean
+    CSMs are computed, along with the squared norm of each row,
+    computing them the first time they're needed and keeping them
+    with the song's features like getBatchSSMNeighbors
+    :param Features: Dictionary of precomputed features for a song
+    :param key: Name of the feature, e.g. 'MFCCs0'
+    :param dtype: Type of the CSMs
+    :returns (X, XSqr): The feature and its squared row norms
+    """
+    CKey = ('CSMFeatures', key, np.dtype(dtype).str)
+    if not CKey in Features:
+        X = np.ascontiguousarray(Features[key], dtype=dtype)
+        Features[CKey] = (X, getCSMRowSqr(X, dtype))
+    return Features[CKey]
+
+def getBatchBuffer(Buffers, key, shape, dtype):
+    """
+    Get an array of a given shape out of a dictionary of flat
+    buffers that are reused from one tempo level pair to the next,
+    growing the buffer if it's too small
+    :param Buffers: Dictionary of buffers, updated in place
+    :param key: Name of the buffer
+    :param shape: Shape of the array
+    :param dtype: Type of the array
+    :returns: An array of the given shape that is a view into the buffer
+    """
+    size = int(np.prod(shape))
+    if not key in Buffers or Buffers[key].size < size or Buffers[key].dtype != dtype:
+        Buffers[key] = np.empty(size, dtype=dtype)
+    return Buffers[key][0:size].reshape(shape)
+
+def getBatchCSM(Features1, Features2, F, a, b, O1, O2, CSMType, dtype = np.float64, Buffers = None):
+    """
+    Compute the cross-similarity matrix between two songs for one
+    feature at one pair of tempo levels.  Euclidean CSMs are done
+    with getCSMTiled, reusing the row norms of each song and, if
+    Buffers is given, writing into a buffer that's reused
+    :param Features1: Dictionary of precomputed features for song 1
+    :param Features2: Dictionary of precomputed features for song 2
+    :param F: Name of the feature
+    :param a: Tempo level of song 1
+    :param b: Tempo level of song 2
+    :param O1: Auxiliary info for song 1
+    :param O2: Auxiliary info for song 2
+    :param CSMType: Type of cross-similarity for this feature
+    :param dtype: Type in which to compute Euclidean CSMs
+    :param Buffers: (Optional) Dictionary of reusable buffers (see getBatchBuffer)
+    :returns CSMAB: The cross-similarity matrix
+    """
+    (key1, key2) = ('%s%i'%(F, a), '%s%i'%(F, b))
+    if not CSMType == 'Euclidean':
+        return getCSMType(Features1[key1], O1, Features2[key2], O2, CSMType)
+    (X, XSqr) = getBatchCSMFeatures(Features1, key1, dtype)
+    (Y, YSqr) = getBatchCSMFeatures(Features2, key2, dtype)
+    out = None
+    if Buffers is not None:
+        out = getBatchBuffer(Buffers, 'CSM%s'%F, (X.shape[0], Y.shape[0]), dtype)
+    return getCSMTiled(X, Y, XSqr, YSqr, out, dtype=dtype)
+
+def getTempoPairProxyScores(Features1, Features2, Kappa, CSMTypes, BlockParams = {}):
+    """
+    Quickly estimate how promising each pair of tempo levels is
+    before running full similarity fusion on it
+    :param Features1: Dictionary of precomputed features for song 1
+    :param Features2: Dictionary of precomputed features for song 2
+    :param Kappa: Nearest neighbors param for binary CSMs
+    :param CSMTypes: Dictionary of types of CSMs for each feature
+    :param BlockParams: Dictionary of options
+        'TempoProxy': 'CSM' (default) to use the Smith Waterman score
+            of a binary CSM on a downsampled single feature, or 'Tempo'
+            to prefer pairs whose tempos are closest
+        'TempoProxyFeature': Feature for the 'CSM' proxy
+            (default 'Chromas' if it's there, else the first feature)
+        'TempoProxyDownsample': Take every this many blocks for the
+            'CSM' proxy (default 4)
+    :returns Proxy: Dictionary {(a, b): score}, where higher scores
+        are more promising
+    """
+    Proxy = {}
+    TempoProxy = 'CSM'
+    if 'TempoProxy' in BlockParams:
+        TempoProxy = BlockParams['TempoProxy']
+    F = list(CSMTypes.keys())[0]
+    if 'Chromas' in CSMTypes:
+        F = 'Chromas'
+    if 'TempoProxyFeature' in BlockParams:
+        F = BlockParams['TempoProxyFeature']
+    d = 4
+    if 'TempoProxyDownsample' in BlockParams:
+        d = BlockParams['TempoProxyDownsample']
+    for a in range(Features1['NTempos']):
+        O1 = {'ChromaMean':Features1['ChromaMean%i'%a].flatten()}
+        for b in range(Features2['NTempos']):
+            if TempoProxy == 'Tempo':
+                ratio = float(Features1['tempos%i'%a])/float(Features2['tempos%i'%b])
+                Proxy[(a, b)] = -np.abs(np.log(ratio))
+                continue
+            O2 = {'ChromaMean':Features2['ChromaMean%i'%b].flatten()}
+            CSMAB = getCSMType(Features1['%s%i'%(F, a)][0::d, :], O1, Features2['%s%i'%(F, b)][0::d, :], O2, CSMTypes[F])
+            Proxy[(a, b)] = getSWScore(CSMToBinaryMutual(CSMAB, Kappa, packed = True))
+    return Proxy
+
+def compareBatchPair(Features1, Features2, Kappa, CSMTypes, BlockParams = {}):
+    """
+    Compare two songs at all pairs of tempo levels, using early
+    similarity network fusion as well as each individual feature,
+    and keep the best score over all tempo levels for each
+    :param Features1: Dictionary of precomputed features for song 1
+    :param Features2: Dictionary of precomputed features for song 2
+    :param Kappa: Percent nearest neighbors to use both for
+        binary cross-similarity and similarity network fusion
+    :param CSMTypes: Dictionary of types of features and
+        associated cross-similarity comparisons to do
+    :param BlockParams: Dictionary of extra options (see compareBatchBlock)
+    :returns Scores: Dictionary of scores for 'SNF' and for each feature
+    """
+    K = BATCH_FUSION_K
+    NIters = 3
+    Scores = {'SNF':0.0}
+    for Feature in CSMTypes.keys():
+        Scores[Feature] = 0.0
+    TempoPairs = [(a, b) for a in range(Features1['NTempos']) for b in range(Features2['NTempos'])]
+    if 'TempoPairs' in BlockParams and BlockParams['TempoPairs'] > 0 and len(TempoPairs) > BlockParams['TempoPairs']:
+        #Only run the most promising tempo level pairs through fusion
+        Proxy = getTempoPairProxyScores(Features1, Features2, Kappa, CSMTypes, BlockParams)
+        TempoPairs = sorted(TempoPairs, key = lambda ab: -Proxy[ab])[0:BlockParams['TempoPairs']]
+    CSMDtype = np.dtype(BlockParams.get('CSMDtype', 'float64'))
+    #Every tempo level pair is scored before the next one
+    #starts, so they can all share the same CSM buffers
+    Buffers = {}
+    for (a, b) in TempoPairs:
+        (Ps, Ss, M, OtherCSMs, NIndexes) = getBatchPairPS(Features1, Features2, a, b, Kappa, CSMTypes, K, CSMDtype, Buffers)
+        #Do Similarity Fusion
+        if BlockParams.get('FusionEngine', 'Dense') == 'Sparse':
+            D = doSimilarityFusionPSSparse(Ps, Ss, NIters, 1, BlockParams.get('FusionKeepK', BATCH_FUSION_KEEP_K), BlockParams.get('FusionMassTol', 1e-4))
+        else:
+            D = doSimilarityFusionPS(Ps, Ss, NIters, 1)
+        scoreBatchPairFusion(Scores, D, M, OtherCSMs, NIndexes, Kappa)
+    return Scores
+
+def getBatchPairPS(Features1, Features2, a, b, Kappa, CSMTypes, K, CSMDtype = np.float64, Buffers = None):
+    """
+    Set up early similarity fusion between two songs at one
+    pair of tempo levels
+    :param Features1: Dictionary of precomputed features for song 1
+    :param Features2: Dictionary of precomputed features for song 2
+    :param a: Tempo level of song 1
+    :param b: Tempo level of song 2
+    :param Kappa: Percent nearest neighbors to use for the CSM parts
+    :param CSMTypes: Dictionary of types of features and
+        associated cross-similarity comparisons to do
+    :param K: Number of nearest neighbors in fusion
+    :param CSMDtype: Type in which to compute Euclidean CSMs
+    :param Buffers: (Optional) Dictionary of buffers to reuse for
+        the CSMs (see getBatchCSM).  The CSMs that are returned are
+        then only good until the next call with the same buffers
+    :returns (Ps, Ss, M, OtherCSMs, NIndexes): The P and S matrices
+        of each feature (see getPSBlocks), the number of blocks in
+        song 1, and the cross-similarity matrix of each feature along
+        with its nearest neighbors (see getNeighborIndex)
+    """
+    O1 = {'ChromaMean':Features1['ChromaMean%i'%a].flatten()}
+    O2 = {'ChromaMean':Features2['ChromaMean%i'%b].flatten()}
+    Ps = []
+    Ss = []
+    OtherCSMs = {}
+    NIndexes = {}
+    #Compute all W matrices
+    (M, N) = (0, 0)
+    for F in CSMTypes.keys():
+        CSMAB = getBatchCSM(Features1, Features2, F, a, b, O1, O2, CSMTypes[F], CSMDtype, Buffers)
+        OtherCSMs[F] = CSMAB
+        (M, N) = (CSMAB.shape[0], CSMAB.shape[1])
+        k1 = int(0.5*Kappa*M)
+        k2 = int(0.5*Kappa*N)
+        #Find the neighbors once for both the W matrix and the
+        #binary cross-similarity matrix, with one extra for the
+        #tie check in getMutualNeighborsMask
+        NIndex = getNeighborIndex(CSMAB, max(k2, getBinaryNeighbors(N, Kappa)+1), max(k1, getBinaryNeighbors(M, Kappa)+1))
+        NIndexes[F] = NIndex
+        WCSMAB = getWCSM(CSMAB, k1, k2, NIndex = NIndex)
+        #Work on the blocks of the fusion matrix directly, reusing
+        #what only depends on each song's own SSM
+        WSSMA = getBatchW(Features1, 'W%s%i'%(F, a))
+        WSSMB = getBatchW(Features2, 'W%s%i'%(F, b))
+        NeighbsA = getBatchSSMNeighbors(Features1, 'W%s%i'%(F, a), K)
+        NeighbsB = getBatchSSMNeighbors(Features2, 'W%s%i'%(F, b), K)
+        (P, S) = getPSBlocks(WSSMA, WSSMB, WCSMAB, K, NeighbsA, NeighbsB)
+        Ps.append(P)
+        Ss.append(S)
+    return (Ps, Ss, M, OtherCSMs, NIndexes)
+
+def scoreBatchPairFusion(Scores, D, M, OtherCSMs, NIndexes, Kappa):
+    """
+    Align the fused cross-similarity at one pair of tempo levels, as
+    well as the cross-similarity of each individual feature, and keep
+    the best score of each over all tempo levels
+    :param Scores: Dictionary of best scores so far, updated in place
+    :param D: Fused matrix from similarity fusion
+    :param M: Number of blocks in the first song
+    :param OtherCSMs: Dictionary of cross-similarity matrices of each feature
+    :param NIndexes: Dictionary of the neighbor index of each of those
+    :param Kappa: Percent nearest neighbors for binary cross-similarity
+    """
+    #Extract CSM Part
+    CSM = D[0:M, M::] + D[M::, 0:M].T
+    DBinary = CSMToBinaryMutual(np.exp(-CSM), Kappa, packed = True)
+    score = getSWScore(DBinary)
+    Scores['SNF'] = max(score, Scores['SNF'])
+    #In addition to fusion, compute scores for individual
+    #features to be used with the fusion later
+    for Feature in OtherCSMs:
+        DBinary = CSMToBinaryMutual(OtherCSMs[Feature], Kappa, NIndexes[Feature], packed = True)
+        score = getSWScore(DBinary)
+        Scores[Feature] = max(Scores[Feature], score)
+
+def replayBatchJournal(JournalFilename, idxs, Ds):
+    """
+    Fill in the scores of all song pairs recorded in a block's journal
+    by a previous run that didn't finish.  A pair only counts as done
+    if the scores for every feature type were written, so a line that
+    was cut off by a crash is simply computed again
+    :param JournalFilename: Path to the journal
+    :param idxs: [start1, end1, start2, end2] range of the block
+    :param Ds: Dictionary of score matrices for the block, which is
+        updated in place
+    :returns Done: Set of local (i, j) indices of finished pairs
+    """
+    Done = set([])
+    if not os.path.exists(JournalFilename):
+        return Done
+    counts = {}
+    fin = open(JournalFilename, 'r')
+    for line in fin.readlines():
+        fields = line.split("\t")
+        if not line[-1] == "\n" or len(fields) < 4 or not fields[2] in Ds:
+            continue
+        (i, j) = (int(fields[0]) - idxs[0], int(fields[1]) - idxs[2])
+        Ds[fields[2]][i, j] = float(fields[3])
+        counts[(i, j)] = counts.get((i, j), 0) + 1
+    fin.close()
+    for ij in counts:
+        if counts[ij] >= len(Ds):
+            Done.add(ij)
+    return Done
+
 def compareBatchBlock(args):
     """
     Process a rectangular block of the all pairs score matrix
     between all of the songs.  Return score matrices for each
     individual type of feature, in addition to one for early
-    similarity network fusion
+    similarity network fusion.  As song pairs finish, their scores
+    are appended to a journal next to the block's results, so that
+    a block which gets killed partway through picks up where it
+    left off the next time it's run
     :param idxs: [start1, end1, start2, end2] range of rectangular
         block of songs to compare
     :param Kappa: Percent nearest neighbors to use both for
@@ -37,15 +406,41 @@ def compareBatchBlock(args):
     :param allFiles: List of all files that are being compared
         from which this block is drawn
     :param scratchDir: Path to directory for storing block results
+    :param BlockParams: (Optional) Dictionary of extra options
+        'FeatureFiles': List of .mat feature files parallel with
+            allFiles (see FeatureCache.py).  By default, features
+            are looked up with getMatFilename
+        'JournalInterval': Minimum number of seconds between flushes
+            of the journal to disk (default 60)
+        'TempoPairs': If > 0, only run this many of the most promising
+            pairs of tempo levels for each song pair through fusion and
+            alignment, as ranked by getTempoPairProxyScores.  0 (default)
+            means exhaustively compare all pairs of tempo levels
+        'TempoProxy', 'TempoProxyFeature', 'TempoProxyDownsample':
+            Options for the ranking (see getTempoPairProxyScores)
+        'FusionEngine': 'Dense' (default) for doSimilarityFusionWs, or
+            'Sparse' for doSimilarityFusionWsSparse, which keeps the
+            diffusion sparse and runs in single precision
+        'FusionKeepK', 'FusionMassTol': Truncation of the rows of the
+            sparse engine (see sparseRowTopK).  Defaults
+            BATCH_FUSION_KEEP_K and 1e-4
+        'CSMDtype': Type in which Euclidean CSMs are computed with
+            getCSMTiled, e.g. 'float32'.  Default 'float64'
     """
-    (idxs, Kappa, CSMTypes, allFiles, scratchDir) = args
-    DsFilename = "%s/D%i_%i_%i_%i.mat"%(scratchDir, idxs[0], idxs[1], idxs[2], idxs[3])
+    (idxs, Kappa, CSMTypes, allFiles, scratchDir) = args[0:5]
+    BlockParams = {}
+    if len(args) > 5:
+        BlockParams = args[5]
+    DsFilename = getBatchBlockFilename(scratchDir, idxs, Kappa, CSMTypes, BlockParams)
     if os.path.exists(DsFilename):
         return sio.loadmat(DsFilename)
+    JournalFilename = "%s.journal"%DsFilename[0:-4]
+    JournalInterval = 60
+    if 'JournalInterval' in BlockParams:
+        JournalInterval = BlockParams['JournalInterval']
     #Figure out block size thisM x thisN
     thisM = idxs[1] - idxs[0]
     thisN = idxs[3] - idxs[2]
-    D = np.zeros((thisM, thisN))
 
     AllFeatures = {}
     tic = time.time()
@@ -54,23 +449,26 @@ def compareBatchBlock(args):
     allidxs = np.unique(np.array(allidxs))
     #Preload features and Ws for SSM parts
     ticfeatures = time.time()
-    count = 1
     for idx in allidxs:
-        filename = getMatFilename(scratchDir, allFiles[idx])
-        AllFeatures[idx] = sio.loadmat(filename)
-        for key, val in AllFeatures[idx].items():
-            if type(val) is np.ndarray:
-                if val.size == 1:
-                    AllFeatures[idx][key] = val.flatten()[0]
+        if 'FeatureFiles' in BlockParams:
+            filename = BlockParams['FeatureFiles'][idx]
+        else:
+            filename = getMatFilename(scratchDir, allFiles[idx])
+        AllFeatures[idx] = getBatchFeatures(scratchDir, filename)
     tocfeatures = time.time()
     print("Elapsed Time Loading Features: ", tocfeatures-ticfeatures)
     stdout.flush()
 
-    K = 20
-    NIters = 3
     Ds = {'SNF':np.zeros((thisM, thisN))}
     for Feature in CSMTypes.keys():
         Ds[Feature] = np.zeros((thisM, thisN))
+    #Pick up scores from an earlier run of this block that didn't finish
+    Done = replayBatchJournal(JournalFilename, idxs, Ds)
+    if len(Done) > 0:
+        print("Resuming block with %i pairs already done"%len(Done))
+    fjournal = open(JournalFilename, 'a')
+    lines = []
+    lastFlush = time.time()
     for i in range(thisM):
         print("i = %i"%i)
         stdout.flush()
@@ -81,43 +479,32 @@ def compareBatchBlock(args):
             if thisj < thisi:
                 #Only compute upper triangular part since it's symmetric
                 continue
+            if (i, j) in Done:
+                continue
             Features2 = AllFeatures[thisj]
-            #Compare all tempo levels
-            for a in range(Features1['NTempos']):
-                O1 = {'ChromaMean':Features1['ChromaMean%i'%a].flatten()}
-                for b in range(Features2['NTempos']):
-                    O2 = {'ChromaMean':Features2['ChromaMean%i'%b].flatten()}
-                    Ws = []
-                    OtherCSMs = {}
-                    #Compute all W matrices
-                    (M, N) = (0, 0)
-                    for F in CSMTypes.keys():
-                        CSMAB = getCSMType(Features1['%s%i'%(F, a)], O1, Features2['%s%i'%(F, b)], O2, CSMTypes[F])
-                        OtherCSMs[F] = CSMAB
-                        (M, N) = (CSMAB.shape[0], CSMAB.shape[1])
-                        k1 = int(0.5*Kappa*M)
-                        k2 = int(0.5*Kappa*N)
-                        WCSMAB = getWCSM(CSMAB, k1, k2)
-                        WSSMA = Features1['W%s%i'%(F, a)]
-                        WSSMB = Features2['W%s%i'%(F, b)]
-                        Ws.append(setupWCSMSSM(WSSMA, WSSMB, WCSMAB))
-                    #Do Similarity Fusion
-                    D = doSimilarityFusionWs(Ws, K, NIters, 1)
-                    #Extract CSM Part
-                    CSM = D[0:M, M::] + D[M::, 0:M].T
-                    DBinary = CSMToBinaryMutual(np.exp(-CSM), Kappa)
-                    score = SAC.swalignimpconstrained(DBinary)
-                    Ds['SNF'][i, j] = max(score, Ds['SNF'][i, j])
-                    #In addition to fusion, compute scores for individual
-                    #features to be used with the fusion later
-                    for Feature in OtherCSMs:
-                        DBinary = CSMToBinaryMutual(OtherCSMs[Feature], Kappa)
-                        score = SAC.swalignimpconstrained(DBinary)
-                        Ds[Feature][i, j] = max(Ds[Feature][i, j], score)
+            Scores = compareBatchPair(Features1, Features2, Kappa, CSMTypes, BlockParams)
+            for Feature in Scores:
+                Ds[Feature][i, j] = Scores[Feature]
+                lines.append("%i\t%i\t%s\t%.17g\n"%(thisi, thisj, Feature, Scores[Feature]))
+            if time.time() - lastFlush >= JournalInterval:
+                fjournal.write("".join(lines))
+                fjournal.flush()
+                os.fsync(fjournal.fileno())
+                lines = []
+                lastFlush = time.time()
+    fjournal.write("".join(lines))
+    fjournal.close()
     toc = time.time()
     print("Elapsed Time Block: ", toc-tic)
     stdout.flush()
-    sio.savemat(DsFilename, Ds)
+    #Write the results atomically, since their existence marks
+    #the block as finished
+    tmpfilename = "%s.%s.tmp"%(DsFilename, getQueueWorkerName())
+    fout = open(tmpfilename, 'wb')
+    sio.savemat(fout, Ds)
+    fout.close()
+    os.replace(tmpfilename, DsFilename)
+    os.remove(JournalFilename)
     return Ds
 
 def getBatchBeats(TempoLevels, audiofilename, XAudio, Fs, hopSize, ret, consolidateTempos = True):
@@ -148,6 +535,58 @@ def getBatchBeats(TempoLevels, audiofilename, XAudio, Fs, hopSize, ret, consolid
         tempos.append(tempo)
     return tempos
 
+def getPrecomputeFilename(args):
+    """
+    Return the path of the .mat file to which precomputeBatchFeatures
+    will save features, given the same arguments
+    """
+    if len(args) > 8:
+        return args[8]
+    return getMatFilename(args[1], args[0])
+
+def precomputeBatchFeaturesTimed(args):
+    """
+    Run precomputeBatchFeatures and time it
+    :returns (audiofilename, elapsed time in seconds)
+    """
+    tic = time.time()
+    precomputeBatchFeatures(args)
+    return (args[0], time.time() - tic)
+
+def precomputeBatchFeaturesDynamic(parpool, args):
+    """
+    Precompute features for many songs in parallel, handing songs
+    to workers one at a time from longest to shortest, so that a
+    long song never holds up a chunk of short ones and the short
+    songs fill in at the end.  To cap the memory growth of the workers,
+    make the pool with maxtasksperchild, so that they're restarted
+    after a number of songs
+    :param parpool: A multiprocessing pool
+    :param args: List of arguments to precomputeBatchFeatures
+    """
+    args = [a for a in args if not os.path.exists(getPrecomputeFilename(a))]
+    if len(args) == 0:
+        return
+    #Order songs by duration, falling back to file size
+    #if the duration of any of them can't be determined
+    durations = parpool.map(getAudioDuration, [a[0] for a in args])
+    if None in durations:
+        durations = [0]*len(args)
+        for i in range(len(args)):
+            if os.path.exists(args[i][0]):
+                durations[i] = os.path.getsize(args[i][0])
+    order = np.argsort(-np.array(durations, dtype=np.float64), kind='stable')
+    args = [args[i] for i in order]
+    tic = time.time()
+    count = 0
+    totalTime = 0.0
+    for (filename, elapsed) in parpool.imap_unordered(precomputeBatchFeaturesTimed, args, chunksize = 1):
+        count += 1
+        totalTime += elapsed
+        wall = time.time() - tic
+        print("Finished features %i of %i for %s in %.3g seconds (%.3g songs/minute, %.3g workers busy on average)"%(count, len(args), filename, elapsed, 60.0*count/wall, totalTime/wall))
+        stdout.flush()
+
 def precomputeBatchFeatures(args):
     """
     Precompute all of the features for a file, including
@@ -163,15 +602,20 @@ def precomputeBatchFeatures(args):
     :param CSMTypes: Dictionary of types of features and
         associated cross-similarity comparisons to do
     :param FeatureParams: Dictionary of parameters for computing
-                        features using BlockWindowFeatures.py
+                        features using BlockWindowFeatures.py.  If it
+                        contains 'SparseWNeighbors', the SSM W matrices
+                        are stored sparsely (see saveBatchW)
     :param TempoLevels: An array of tempo biases.  If this array
         contains a 0, compute Madmom tempos.  Otherwise, do
         dynamic programming beat tracking with that bias
     :param PFeatures: Precomputed features
+    :param featurefilename: (Optional) Path of the .mat file to which
+        to save the features (e.g. from FeatureCache.py).  By default,
+        this is given by getMatFilename
     """
-    (audiofilename, scratchDir, hopSize, Kappa, CSMTypes, FeatureParams, TempoLevels, PFeatures) = args
+    (audiofilename, scratchDir, hopSize, Kappa, CSMTypes, FeatureParams, TempoLevels, PFeatures) = args[0:8]
     tic = time.time()
-    filename = getMatFilename(scratchDir, audiofilename)
+    filename = getPrecomputeFilename(args)
     if os.path.exists(filename):
         print("Skipping...")
         return
@@ -231,12 +675,18 @@ def precomputeBatchFeatures(args):
             ret['%s%i'%(F, tidx)] = Feats[F]
             SSM = getCSMType(Feats[F], O, Feats[F], O, CSMTypes[F])
             K = int(0.5*Kappa*SSM.shape[0])
-            ret['W%s%i'%(F, tidx)] = getW(SSM, K)
+            saveBatchW(ret, 'W%s%i'%(F, tidx), getW(SSM, K), FeatureParams)
 
     ret['NTempos'] = len(tempos)
     print("%i Unique Tempos"%len(tempos))
     print("Elapsed Time: %g"%(time.time() - tic))
-    sio.savemat(filename, ret)
+    #Write the features atomically through a temporary file of this
+    #worker's own, since their existence marks the song as done
+    tmpfilename = "%s.%s.tmp"%(filename, getQueueWorkerName())
+    fout = open(tmpfilename, 'wb')
+    sio.savemat(fout, ret)
+    fout.close()
+    os.replace(tmpfilename, filename)
 
 def assembleBatchBlocks(FeatureTypes, res, ranges, N):
     """
@@ -265,6 +715,115 @@ def assembleBatchBlocks(FeatureTypes, res, ranges, N):
 
     return Ds
 
+def compareBatchBlockIdxs(args):
+    """
+    Same as compareBatchBlock, but also return the range of the
+    block, so that results can be matched up with their blocks
+    when they come back out of order
+    :returns (idxs, Ds)
+    """
+    return (args[0], compareBatchBlock(args))
+
+def openBatchScoreMatrices(scratchDir, FeatureTypes, N):
+    """
+    Create one NxN float32 score matrix per feature type as a
+    memory mapped .npy file in the scratch directory, so that the
+    full matrices never need to be held in memory, and so that they
+    can be loaded (e.g. with np.load(..., mmap_mode='r')) to look at
+    partial results while blocks are still being computed
+    :param scratchDir: Path to directory in which to store the matrices
+    :param FeatureTypes: The types of features
+    :param N: The total batch is NxN
+    :returns Ds: A dictionary of NxN memory mapped matrices
+    """
+    Ds = {}
+    for Feature in FeatureTypes:
+        filename = "%s/Scores%s.npy"%(scratchDir, Feature)
+        Ds[Feature] = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(N, N))
+    return Ds
+
+def addBatchBlock(Ds, idxs, Block):
+    """
+    Write the upper triangular scores from one block into full
+    score matrices, along with their mirror image below the diagonal
+    :param Ds: A dictionary of NxN matrices, updated in place
+    :param idxs: [start1, end1, start2, end2] range of the block
+    :param Block: Dictionary of block results from compareBatchBlock
+    """
+    [i1, i2, j1, j2] = idxs
+    U = np.arange(j1, j2)[None, :] >= np.arange(i1, i2)[:, None]
+    for Feature in Ds:
+        B = np.asarray(Block[Feature], dtype=Ds[Feature].dtype)
+        Sub = Ds[Feature][i1:i2, j1:j2]
+        Sub[U] = B[U]
+        Sub = Ds[Feature][j1:j2, i1:i2].T
+        Sub[U] = B[U]
+
+def streamBatchBlocks(parpool, args, Ds):
+    """
+    Compare blocks in parallel and write each one into the score
+    matrices as soon as it is finished, instead of waiting for all of
+    them and assembling them at the end
+    :param parpool: A multiprocessing pool
+    :param args: List of arguments to compareBatchBlock
+    :param Ds: A dictionary of NxN matrices, one per feature type,
+        e.g. from openBatchScoreMatrices.  Updated in place
+    :returns Ds: The filled in score matrices
+    """
+    args = list(args)
+    tic = time.time()
+    count = 0
+    for (idxs, Block) in parpool.imap_unordered(compareBatchBlockIdxs, args, chunksize = 1):
+        addBatchBlock(Ds, idxs, Block)
+        count += 1
+        print("Finished block %i of %i (Elapsed Time %g)"%(count, len(args), time.time()-tic))
+        stdout.flush()
+    for Feature in Ds:
+        if type(Ds[Feature]) is np.memmap:
+            Ds[Feature].flush()
+    return Ds
+
+def getLateFusionDistances(Late, idx):
+    """
+    Get one row of distances out of the result of late fusion
+    :param Late: NxN fused similarity matrix, dense or sparse.  Song
+        pairs that are missing from a sparse one have similarity 0
+    :param idx: Index of the song
+    :returns: Array of N distances from the song to every song
+    """
+    if sparse.issparse(Late):
+        row = Late[idx, :].toarray().flatten()
+    else:
+        row = np.array(Late[idx, :]).flatten()
+    return np.exp(-row) #Turn similarity score into a distance
+
+def runBatchQueue(queueDir, funcName, args, Shared, NWorkers, leaseSeconds = 600, maxAttempts = 3):
+    """
+    Put tasks into a job queue on a shared file system, work on them
+    with NWorkers processes on this machine alongside any workers that
+    were started on other machines with "python JobQueue.py <queueDir>",
+    and wait until every task is done
+    :param queueDir: Path to the queue directory
+    :param funcName: Full name of the function to run on each task,
+        e.g. "BatchCollection.compareBatchBlock"
+    :param args: List of argument tuples, one per task
+    :param Shared: Dictionary of arguments shared between tasks
+        (see submitQueueTasks)
+    :param NWorkers: Number of worker processes to run on this machine
+    :param leaseSeconds: Seconds after which the task of a worker
+        that has stopped responding is given to another worker
+    :param maxAttempts: Number of times to try each task
+    :returns: A generator of (task index, result)
+    """
+    N = submitQueueTasks(queueDir, funcName, args, Shared)
+    print("Submitted %i tasks; other machines can help with \"python JobQueue.py %s\""%(N, queueDir))
+    stdout.flush()
+    workers = startQueueWorkers(queueDir, NWorkers, leaseSeconds, maxAttempts)
+    for p in workers:
+        p.join()
+    waitForQueue(queueDir)
+    return getQueueResults(queueDir)
+
 def getBatchBlockRanges(N, NPerBlock):
     """
     Get the row and column index ranges of all blocks in an
@@ -285,3 +844,340 @@ def getBatchBlockRanges(N, NPerBlock):
             j2 = min(j1+NPerBlock, N)
             ranges.append([i1, i2, j1, j2])
     return ranges
+
+def getBatchBlockBounds(start, end, NPerBlock, Beats = None):
+    """
+    Split the songs in the interval [start, end) into stripes of
+    about NPerBlock songs each
+    :param start: Index of the first song
+    :param end: One past the index of the last song
+    :param NPerBlock: The number of songs in a stripe
+    :param Beats: If specified, a list of arrays of beat counts for
+        all songs, and the stripes are chosen to have equal numbers
+        of beats instead of equal numbers of songs
+    :returns bounds: A list of indices [start, ..., end]
+    """
+    N = end - start
+    K = int(np.ceil(N/float(NPerBlock)))
+    if Beats is None or K < 2:
+        return [min(start + k*NPerBlock, end) for k in range(K+1)]
+    w = np.cumsum([np.sum(b) for b in Beats[start:end]])
+    bounds = np.searchsorted(w, w[-1]*np.arange(1, K)/float(K), side='right')
+    bounds = np.unique(np.concatenate(([0], bounds, [N])))
+    return [int(b) + start for b in bounds]
+
+def getBatchBlockRangesTriangular(N, NPerBlock, Beats = None):
+    """
+    Get the row and column index ranges of only those blocks in an
+    all pairs similarity experiment that touch the upper triangular
+    part of the NxN matrix (including the diagonal).  Since the score
+    matrix is symmetric, these are the only blocks that do any work
+    :param N: The N songs in the experiment for an NxN matrix
+    :param NPerBlock: The number of elements in a square block
+    :param Beats: If specified, a list of arrays of beat counts for
+        each song (as returned by getBatchSongBeats).  The block
+        boundaries are then placed so that each stripe of songs has
+        roughly the same total number of beats, rather than the same
+        number of songs
+    :returns ranges: An array of ranges [[starti, endi, startj, endj]]
+        comprising each block
+    """
+    bounds = getBatchBlockBounds(0, N, NPerBlock, Beats)
+    ranges = []
+    for i in range(len(bounds)-1):
+        for j in range(i, len(bounds)-1):
+            ranges.append([bounds[i], bounds[i+1], bounds[j], bounds[j+1]])
+    return ranges
+
+def getBatchSongBeats(allFiles, scratchDir, FeatureFiles = None):
+    """
+    Look up the number of beats at each tempo level of every song
+    from the headers of the precomputed feature files, without
+    loading any of the features themselves
+    :param allFiles: List of all files that are being compared
+    :param scratchDir: Path to directory holding the features
+    :param FeatureFiles: (Optional) List of .mat feature files
+        parallel with allFiles.  By default, use getMatFilename
+    :returns Beats: A list of arrays of beat counts, one per song
+    """
+    if FeatureFiles is None:
+        FeatureFiles = [getMatFilename(scratchDir, f) for f in allFiles]
+    Beats = []
+    for filename in FeatureFiles:
+        counts = {}
+        for (name, shape, _) in sio.whosmat(filename):
+            if name.startswith('beats'):
+                counts[int(name[5::])] = max(shape)
+        Beats.append(np.array([counts[t] for t in sorted(counts)], dtype=np.float64))
+    return Beats
+
+def getBatchSongBytes(allFiles, scratchDir, FeatureFiles = None, CSMTypes = None):
+    """
+    Add up the size of all of the precomputed features of every song
+    from the headers of its feature file, without loading them
+    :param allFiles: List of all files that are being compared
+    :param scratchDir: Path to directory holding the features
+    :param FeatureFiles: (Optional) List of .mat feature files
+        parallel with allFiles.  By default, use getMatFilename
+    :param CSMTypes: (Optional) If specified, also count what gets cached
+        with each song's features while its block is compared: the
+        neighbors of each SSM affinity matrix (getBatchSSMNeighbors),
+        and a copy of each Euclidean feature with its row norms
+        (getBatchCSMFeatures)
+    :returns SongBytes: An array of the number of bytes of each song
+    """
+    if FeatureFiles is None:
+        FeatureFiles = [getMatFilename(scratchDir, f) for f in allFiles]
+    SongBytes = np.zeros(len(FeatureFiles))
+    for i, filename in enumerate(FeatureFiles):
+        for (name, shape, mclass) in sio.whosmat(filename):
+            SongBytes[i] += np.prod(shape)*MAT_CLASS_BYTES.get(mclass, 8)
+            if CSMTypes is None:
+                continue
+            #Row sums, plus the columns and values of the K nearest neighbors
+            W = re.match(r'^W([A-Za-z]+)\d+(_indptr)?$', name)
+            if W and W.group(1) in CSMTypes:
+                rows = np.prod(shape)-1 if W.group(2) else shape[0]
+                SongBytes[i] += 8.0*rows*(1+2*BATCH_FUSION_K)
+            X = re.match(r'^([A-Za-z]+)\d+$', name)
+            if X and CSMTypes.get(X.group(1), None) == 'Euclidean':
+                SongBytes[i] += 8.0*shape[0]*(1+np.prod(shape[1:]))
+    return SongBytes
+
+def getBatchPairBytes(M, N, NViews):
+    """
+    Estimate the peak memory of comparing two songs at one pair of
+    tempo levels.  Similarity fusion holds four dense (M+N)x(M+N)
+    matrices per view (W, P, and two copies of the diffused P), plus
+    about four more between the cross-similarity, the products, and
+    the fused result
+    :param M: Number of blocks in the first song
+    :param N: Number of blocks in the second song
+    :param NViews: Number of feature types being fused
+    :returns: Estimated number of bytes
+    """
+    return (4*NViews + 4)*8.0*(M+N)**2
+
+def getBatchAutoBlockSize(Beats, SongBytes, NViews, MemoryBudget, MaxWorkers):
+    """
+    Pick the number of songs per block and the number of parallel
+    workers so that the block comparisons fit in a memory budget.
+    Every worker must have room for the largest pair of songs in the
+    collection plus the features of all of the songs in its block.
+    As many workers as fit are used, and then blocks are made as large
+    as the remaining memory allows (to cut down on loading features),
+    but small enough that there are still enough blocks to keep all
+    of the workers busy until the end
+    :param Beats: A list of arrays of beat counts for each song,
+        from getBatchSongBeats
+    :param SongBytes: An array of the feature size of each song, along
+        with what is cached with it, from getBatchSongBytes with CSMTypes
+    :param NViews: Number of feature types being fused
+    :param MemoryBudget: Total number of bytes all workers may use
+    :param MaxWorkers: Maximum number of workers (e.g. number of threads)
+    :returns (NPerBlock, NWorkers)
+    """
+    N = len(Beats)
+    MaxBeats = np.sort(np.array([np.max(b) for b in Beats]))
+    PairBytes = getBatchPairBytes(MaxBeats[-1], MaxBeats[max(N-2, 0)], NViews)
+    SongMax = np.max(SongBytes)
+    WorkerMin = WORKER_BASE_BYTES + PairBytes + 2*SongMax
+    NWorkers = int(min(MaxWorkers, MemoryBudget // WorkerMin))
+    if NWorkers < 1:
+        print("Warning: Even one worker is estimated to need %.3g GB, which is more than the budget of %.3g GB"%(WorkerMin/1e9, MemoryBudget/1e9))
+        return (1, 1)
+    #A block of NPerBlock x NPerBlock songs loads up to 2*NPerBlock songs
+    NPerBlock = int((MemoryBudget/NWorkers - WORKER_BASE_BYTES - PairBytes) // (2*SongMax))
+    #Triangular blocks along a side of nb blocks make nb(nb+1)/2
+    #blocks, of which there should be at least 4 per worker
+    nb = int(np.ceil((-1 + np.sqrt(1 + 32*NWorkers))/2.0))
+    NPerBlock = max(1, min(NPerBlock, int(np.ceil(N/float(nb)))))
+    print("Using %i songs per block with %i workers, estimated %.3g GB per worker"%(NPerBlock, NWorkers, (WORKER_BASE_BYTES + PairBytes + 2*NPerBlock*SongMax)/1e9))
+    return (NPerBlock, NWorkers)
+
+def getBatchBlockCostSums(Beats):
+    """
+    Precompute the prefix sums that getBatchBlockCost needs, so that
+    the cost of any block can be found in constant time
+    :param Beats: A list of arrays of beat counts for each song
+    :returns Sums: A dictionary of prefix sums, where for a song with
+        beat counts b at different tempo levels, 'T' is over the number
+        of tempos, 'S1' over the sum of b and 'S2' over the sum of b^2,
+        and e.g. 'S2T' is the prefix sum of S2[i]*(prefix sum of T up to i)
+    """
+    X = {}
+    X['T'] = np.array([len(b) for b in Beats], dtype=np.float64)
+    X['S1'] = np.array([np.sum(b) for b in Beats], dtype=np.float64)
+    X['S2'] = np.array([np.sum(np.array(b, dtype=np.float64)**2) for b in Beats], dtype=np.float64)
+    Sums = {}
+    for name in X:
+        Sums[name] = np.concatenate(([0], np.cumsum(X[name])))
+    for (a, b) in [('S2', 'T'), ('T', 'S2'), ('S1', 'S1')]:
+        Sums[a+b] = np.concatenate(([0], np.cumsum(X[a]*Sums[b][0:-1])))
+    return Sums
+
+def getBatchBlockCost(Sums, idxs):
+    """
+    Estimate the cost of comparing a block of songs.  Similarity
+    fusion dominates, and it runs on an (M+N)x(M+N) matrix for every
+    pair of tempo levels, so the cost of a song pair is taken to be
+    the sum of (M+N)^2 over all tempo level pairs.  Pairs below the
+    diagonal are skipped, just like in compareBatchBlock
+    :param Sums: Prefix sums from getBatchBlockCostSums
+    :param idxs: [start1, end1, start2, end2] range of the block
+    :returns: The estimated cost of the block, in arbitrary units
+    """
+    [i1, i2, j1, j2] = idxs
+    def rangeSum(name, k1, k2):
+        return Sums[name][k2] - Sums[name][k1]
+    #The sum of the cost over the whole rectangle, minus the sum over
+    #the pairs (i, j) with j < i.  Rows i in [a1, a2) have all of
+    #[j1, i) below them, and rows i in [b1, i2) have all of [j1, j2)
+    (a1, a2) = (max(i1, j1+1), min(i2, j2+1))
+    b1 = max(i1, j2+1)
+    cost = 0.0
+    for (w, X, Y) in [(1, 'S2', 'T'), (1, 'T', 'S2'), (2, 'S1', 'S1')]:
+        cost += w*rangeSum(X, i1, i2)*rangeSum(Y, j1, j2)
+        if a2 > a1:
+            cost -= w*(rangeSum(X+Y, a1, a2) - Sums[Y][j1]*rangeSum(X, a1, a2))
+        if i2 > b1:
+            cost -= w*rangeSum(X, b1, i2)*rangeSum(Y, j1, j2)
+    return cost
+
+def scheduleBatchBlocks(ranges, Beats):
+    """
+    Order blocks from most to least expensive, so that when they are
+    handed out one at a time to a pool of workers, the big blocks are
+    started first and the small ones fill in the gaps at the end
+    (longest processing time first scheduling)
+    :param ranges: An array of block ranges
+    :param Beats: A list of arrays of beat counts for each song
+    :returns ranges: The same ranges, sorted by decreasing cost
+    """
+    Sums = getBatchBlockCostSums(Beats)
+    costs = [getBatchBlockCost(Sums, r) for r in ranges]
+    order = np.argsort(-np.array(costs), kind='stable')
+    return [ranges[i] for i in order]
+
+def getBatchBlockRangesIncremental(NOld, N, NPerBlock, Beats = None):
+    """
+    Get the blocks needed to grow an all pairs experiment from the
+    first NOld songs to all N songs, when the scores between the first
+    NOld songs are already known.  Every block lies in the columns of
+    the new songs, covering all old x new and the upper triangular part
+    of new x new
+    :param NOld: The number of songs whose scores are already known
+    :param N: The total number of songs
+    :param NPerBlock: The number of elements in a square block
+    :param Beats: (Optional) Beat counts of all songs, as in
+        getBatchBlockRangesTriangular
+    :returns ranges: An array of ranges [[starti, endi, startj, endj]]
+    """
+    rowbounds = getBatchBlockBounds(0, N, NPerBlock, Beats)
+    colbounds = getBatchBlockBounds(NOld, N, NPerBlock, Beats)
+    ranges = []
+    for i in range(len(rowbounds)-1):
+        for j in range(len(colbounds)-1):
+            [i1, i2, j1, j2] = [rowbounds[i], rowbounds[i+1], colbounds[j], colbounds[j+1]]
+            if j2 > i1:
+                ranges.append([i1, i2, j1, j2])
+    return ranges
+
+def getIncrementalBatchOrder(oldFiles, allFiles):
+    """
+    Order the songs in a grown collection so that the songs which
+    were already compared come first, in the same order as before,
+    followed by all of the new songs.  Songs that have been dropped
+    from the collection are left out
+    :param oldFiles: List of files in the previous experiment
+    :param allFiles: List of files in the new experiment
+    :returns (allFiles, oldIdx): The reordered list of files, and
+        the indices of the kept songs in the previous score matrices
+    """
+    allSet = set(allFiles)
+    oldSet = set(oldFiles)
+    oldIdx = [i for i in range(len(oldFiles)) if oldFiles[i] in allSet]
+    newFiles = [oldFiles[i] for i in oldIdx] + [f for f in allFiles if not f in oldSet]
+    return (newFiles, oldIdx)
+
+def growBatchScores(Ds, DsOld, oldIdx, FeatureTypes, N):
+    """
+    Fill the scores between old songs into score matrices that
+    were assembled only from the blocks of an incremental run
+    :param Ds: A dictionary of NxN matrices, as returned from
+        assembleBatchBlocks on incremental blocks.  Updated in place
+    :param DsOld: A dictionary of score matrices from the previous run
+    :param oldIdx: Indices of the kept songs in the previous matrices
+    :param FeatureTypes: The types of features
+    :param N: The total number of songs
+    :returns Ds: The grown score matrices
+    """
+    NOld = len(oldIdx)
+    oldIdx = np.array(oldIdx, dtype=np.int64)
+    #Copy a band of rows at a time, so that old scores which are
+    #memory mapped from disk never have to be held in memory all at once
+    RowsPerChunk = max(1, int(SCORE_CHUNK_BYTES/(4*max(NOld, 1))))
+    for Feature in FeatureTypes:
+        if not Feature in Ds:
+            Ds[Feature] = np.zeros((N, N))
+        for i1 in range(0, NOld, RowsPerChunk):
+            i2 = min(i1+RowsPerChunk, NOld)
+            Ds[Feature][i1:i2, 0:NOld] = DsOld[Feature][oldIdx[i1:i2], :][:, oldIdx]
+    return Ds
+
+def saveBatchScoresSparse(scratchDir, Ds, FeatureTypes):
+    """
+    Save the results of a run whose late fusion was kept sparse.
+    Rather than copying the NxN score matrices into D.mat, which
+    would pull them into memory and overflow the 4GB limit of .mat
+    files for large collections, only the sparse late fusion matrix
+    is stored, along with the paths of the memory mapped score matrices
+    :param scratchDir: Path to directory in which the matrices are stored
+    :param Ds: A dictionary of memory mapped NxN score matrices, plus
+        the sparse late fusion matrix in 'Late'
+    :param FeatureTypes: The types of features with score matrices
+    """
+    ScoreFiles = []
+    for Feature in FeatureTypes:
+        Ds[Feature].flush()
+        ScoreFiles.append(Ds[Feature].filename)
+    sio.savemat("%s/D.mat"%scratchDir, {'Late':sparse.csr_matrix(Ds['Late']),
+                'ScoreFeatures':np.array(FeatureTypes, dtype=object),
+                'ScoreFiles':np.array(ScoreFiles, dtype=object)})
+
+def loadBatchScores(scratchDir):
+    """
+    Load the score matrices saved by a previous run, for an incremental
+    run to grow.  If they were saved with saveBatchScoresSparse, the
+    memory mapped score matrices are moved aside, since opening the
+    score matrices for the new run overwrites them, and they are
+    opened read only from there
+    :param scratchDir: Path to directory in which the matrices are stored
+    :returns DsOld: A dictionary of score matrices from the previous run
+    """
+    DsOld = sio.loadmat("%s/D.mat"%scratchDir)
+    if not 'ScoreFiles' in DsOld:
+        return DsOld
+    Features = [str(np.squeeze(F)) for F in DsOld['ScoreFeatures'].flatten()]
+    ScoreFiles = [str(np.squeeze(F)) for F in DsOld['ScoreFiles'].flatten()]
+    DsOld = {}
+    for (Feature, filename) in zip(Features, ScoreFiles):
+        #If a previous incremental run stopped partway, the scores
+        #will already have been moved aside
+        oldname = "%s.old.npy"%filename[0:-4]
+        if not os.path.exists(oldname):
+            os.rename(filename, oldname)
+        DsOld[Feature] = np.load(oldname, mmap_mode='r')
+    return DsOld
+
+def removeBatchScores(DsOld):
+    """
+    Delete the old score matrices that loadBatchScores moved aside,
+    once they have been copied into the score matrices of a new run
+    :param DsOld: A dictionary of score matrices from loadBatchScores
+    """
+    filenames = [DsOld[F].filename for F in DsOld if isinstance(DsOld[F], np.memmap)]
+    #Drop the memory maps before deleting the files underneath them
+    DsOld.clear()
+    for filename in filenames:
+        os.remove(filename)
@@ -98,25 +98,94 @@ def getCSM(X, Y):
     C[C < 0] = 0
     return np.sqrt(C)
 
-def getCSMEMD1D(X, Y):
+#Rows and columns of each tile in getCSMTiled, small enough that
+#a tile of float32 products stays in cache while it's finished off
+CSM_TILE_SIZE = 256
+
+def getCSMRowSqr(X, dtype = np.float32):
+    """
+    Return the squared norm of each row of X, which only
+    depends on one song, for reuse with getCSMTiled
+    :param X: An Mxd matrix
+    :param dtype: Type in which to compute the norms
+    :returns: An M array of squared norms
+    """
+    X = np.asarray(X, dtype=dtype)
+    return np.sum(X**2, 1)
+
+def getCSMTiled(X, Y, XSqr = None, YSqr = None, out = None, TileSize = CSM_TILE_SIZE, dtype = np.float32):
+    """
+    Return the same Euclidean cross-similarity matrix as getCSM, but
+    a tile at a time in a given precision (float32 by default), so
+    that the only scratch memory is one tile of dot products and
+    every tile is finished off while it's still in cache
+    :param X: An Mxd matrix holding the coordinates of M points
+    :param Y: An Nxd matrix holding the coordinates of N points
+    :param XSqr: (Optional) getCSMRowSqr(X), if it's already known
+    :param YSqr: (Optional) getCSMRowSqr(Y), if it's already known
+    :param out: (Optional) MxN array into which to write the
+        result, so that the caller can reuse one buffer
+    :param TileSize: Number of rows and columns in each tile
+    :param dtype: Type in which to do the computation and of
+        the result if out isn't given
+    :return D: An MxN Euclidean cross-similarity matrix (out,
+        if it was given)
+    """
+    X = np.ascontiguousarray(X, dtype=dtype)
+    Y = np.ascontiguousarray(Y, dtype=dtype)
+    (M, N) = (X.shape[0], Y.shape[0])
+    if XSqr is None:
+        XSqr = getCSMRowSqr(X, dtype)
+    if YSqr is None:
+        YSqr = getCSMRowSqr(Y, dtype)
+    if out is None:
+        out = np.empty((M, N), dtype=dtype)
+    Tile = np.empty(TileSize*TileSize, dtype=dtype)
+    for i1 in range(0, M, TileSize):
+        i2 = min(i1+TileSize, M)
+        for j1 in range(0, N, TileSize):
+            j2 = min(j1+TileSize, N)
+            XY = Tile[0:(i2-i1)*(j2-j1)].reshape((i2-i1, j2-j1))
+            np.dot(X[i1:i2, :], Y[j1:j2, :].T, out=XY)
+            XY *= 2
+            C = out[i1:i2, j1:j2]
+            np.add(XSqr[i1:i2, None], YSqr[None, j1:j2], out=C)
+            C -= XY
+            np.maximum(C, 0, out=C)
+            np.sqrt(C, out=C)
+    return out
+
+#Bytes of scratch memory for each tile of rows in getCSMEMD1D
+EMD_TILE_BYTES = 1 << 20
+
+def getCSMEMD1D(X, Y, TileBytes = EMD_TILE_BYTES):
     """
     Compute an approximate of the earth mover's distance
     between the M points in the Mxd matrix X and the N points
-    in the Nxd matrix Y
+    in the Nxd matrix Y.  This is done a tile of rows at a time,
+    going through all of the bins of a tile while it's still in
+    cache, so the only scratch memory is one tile
     :param X: Mxd matrix
     :param Y: Nxd matrix
+    :param TileBytes: Size of the scratch tile
     :return D: An MxN distance matrix
     """
     M = X.shape[0]
     N = Y.shape[0]
     K = X.shape[1]
     XC = np.cumsum(X, 1)
-    YC = np.cumsum(Y, 1)
+    YC = np.ascontiguousarray(np.cumsum(Y, 1).T)
     D = np.zeros((M, N))
-    for k in range(K):
-        xc = XC[:, k]
-        yc = YC[:, k]
-        D += np.abs(xc[:, None] - yc[None, :])
+    dtype = np.result_type(XC, YC)
+    Rows = int(max(1, min(M, TileBytes/(dtype.itemsize*max(N, 1)))))
+    Diff = np.empty((Rows, N), dtype=dtype)
+    for i1 in range(0, M, Rows):
+        i2 = min(i1+Rows, M)
+        T = Diff[0:i2-i1]
+        for k in range(K):
+            np.subtract(XC[i1:i2, k, None], YC[k][None, :], out=T)
+            np.abs(T, out=T)
+            D[i1:i2] += T
     return D
 
 def getCSMCosine(X, Y):
@@ -174,7 +243,134 @@ def getCSMCosineOTI(X, Y, C1, C2):
     X1 = np.reshape(X1, [X.shape[0], ChromasPerBlock*NChromaBins])
     return getCSMCosine(X1, Y)
 
-def CSMToBinary(D, Kappa):
+#Bytes of the similarities at all transpositions to hold at once
+#in getCSMCosineAllOTI
+OTI_TILE_BYTES = 1 << 26
+
+def getCSMCosineAllOTI(X, Y, C1, C2, TileBytes = OTI_TILE_BYTES):
+    """
+    Get the cosine distance between each row of X and each row of Y
+    at every transposition of X at once, by stacking all of the
+    rotations of a tile of rows of X into one matrix and doing a single
+    matrix product per tile, so only one tile of similarities at
+    every transposition is held in memory at a time
+    :param X: Mxd matrix
+    :param Y: Nxd matrix
+    :param C1: Global chroma vector 1
+    :param C2: Global chroma vector 2
+    :param TileBytes: Size of the similarities at all transpositions
+        for one tile of rows
+    :return (DGlobal, DLocal): MxN distance matrices, where DGlobal
+        is the same as getCSMCosineOTI, with one global optimal
+        transposition, and DLocal uses the best transposition of
+        each pair of blocks
+    """
+    NChromaBins = len(C1)
+    ChromasPerBlock = int(X.shape[1]/NChromaBins)
+    M = X.shape[0]
+    N = Y.shape[0]
+    XNorm = np.sqrt(np.sum(X**2, 1))
+    XNorm[XNorm == 0] = 1
+    YNorm = np.sqrt(np.sum(Y**2, 1))
+    YNorm[YNorm == 0] = 1
+    #Rotating chroma doesn't change the norm, so normalize once.
+    #Row i of idx picks out the bins of np.roll(x, i)
+    XN = np.reshape(X/XNorm[:, None], (M, ChromasPerBlock, NChromaBins))
+    YN = (Y/YNorm[:, None]).T
+    idx = (np.arange(NChromaBins)[None, :] - np.arange(NChromaBins)[:, None]) % NChromaBins
+    oti = getOTI(C1, C2)
+    DGlobal = np.zeros((M, N))
+    DLocal = np.zeros((M, N))
+    Rows = int(max(1, min(M, TileBytes/(8*NChromaBins*max(N, 1)))))
+    for i1 in range(0, M, Rows):
+        i2 = min(i1+Rows, M)
+        XR = np.transpose(XN[i1:i2, :, idx], (2, 0, 1, 3))
+        XR = np.reshape(XR, (NChromaBins*(i2-i1), ChromasPerBlock*NChromaBins))
+        D = np.reshape(XR.dot(YN), (NChromaBins, i2-i1, N))
+        np.subtract(1, D[oti], out=DGlobal[i1:i2])
+        np.max(D, 0, out=DLocal[i1:i2])
+    np.subtract(1, DLocal, out=DLocal)
+    return (DGlobal, DLocal)
+
+def getBinaryNeighbors(M, Kappa):
+    """
+    Return the number of neighbors CSMToBinary takes
+    in each row of a matrix with M columns
+    """
+    if Kappa == 0:
+        return M
+    elif Kappa < 1:
+        return int(np.round(Kappa*M))
+    return int(Kappa)
+
+class PackedCSM(object):
+    """
+    A binary cross-similarity matrix with each row packed 8 columns
+    to a byte, most significant bit first, as with np.packbits.  This
+    takes 64x less memory than a float64 0/1 matrix, and it can be
+    passed straight to getSWScore.  Binary OR and AND (|, &) of two
+    packed matrices of the same shape work byte by byte
+    """
+    def __init__(self, Bits, shape):
+        """
+        :param Bits: (M x ceil(N/8)) uint8 array of packed rows
+        :param shape: (M, N) shape of the unpacked matrix
+        """
+        self.Bits = Bits
+        self.shape = tuple(shape)
+
+    def __or__(self, other):
+        return PackedCSM(self.Bits | other.Bits, self.shape)
+
+    def __and__(self, other):
+        return PackedCSM(self.Bits & other.Bits, self.shape)
+
+    def toarray(self):
+        """
+        :returns: The unpacked (M x N) matrix of 0s and 1s, in float64
+        """
+        B = np.unpackbits(self.Bits, axis=1, count=self.shape[1])
+        return np.array(B, dtype=np.float64)
+
+def packCSM(B):
+    """
+    Pack a binary cross-similarity matrix, where anything
+    greater than 0 counts as a 1
+    :param B: An MxN matrix
+    :returns: A PackedCSM
+    """
+    return PackedCSM(np.packbits(np.asarray(B) > 0, axis=1), B.shape)
+
+def getSWScore(DBinary):
+    """
+    Compute the constrained Smith Waterman score of a
+    binary cross-similarity matrix, dense or packed
+    :param DBinary: An MxN binary matrix or a PackedCSM
+    :returns: The score
+    """
+    if isinstance(DBinary, PackedCSM):
+        return SAC.swalignimpconstrainedpacked(DBinary.Bits, DBinary.shape[1])
+    return SAC.swalignimpconstrained(DBinary)
+
+def getBinaryNeighborsMask(D, Kappa, NIndex = None):
+    """
+    Return a boolean matrix which is True at the nearest neighbors
+    in each row of D (see CSMToBinary for the parameters)
+    """
+    N = D.shape[0]
+    M = D.shape[1]
+    if Kappa == 0:
+        return np.ones((N, M), dtype=bool)
+    NNeighbs = getBinaryNeighbors(M, Kappa)
+    if NIndex is None or NIndex['RowJ'].shape[1] < NNeighbs:
+        J = np.argpartition(D, NNeighbs, 1)[:, 0:NNeighbs]
+    else:
+        J = NIndex['RowJ'][:, 0:NNeighbs]
+    B = np.zeros((N, M), dtype=bool)
+    B[np.arange(N)[:, None], J] = True
+    return B
+
+def CSMToBinary(D, Kappa, NIndex = None, packed = False):
     """
     Turn a cross-similarity matrix into a binary cross-simlarity matrix, using partitions instead of
     nearest neighbors for speed
@@ -183,34 +379,115 @@ def CSMToBinary(D, Kappa):
         If Kappa = 0, take all neighbors
         If Kappa < 1 it is the fraction of mutual neighbors to consider
         Otherwise Kappa is the number of mutual neighbors to consider
+    :param NIndex: (Optional) getNeighborIndex of D, with enough
+        neighbors per row for Kappa
+    :param packed: If True, return a PackedCSM instead of a dense matrix
     :returns B: MxN binary cross-similarity matrix
     """
-    N = D.shape[0]
-    M = D.shape[1]
+    B = getBinaryNeighborsMask(D, Kappa, NIndex)
+    if packed:
+        return PackedCSM(np.packbits(B, axis=1), B.shape)
+    return np.array(B, dtype=np.float64)
+
+def getKthThresholds(D, k, NIndexV = None, RowsPerChunk = 1000):
+    """
+    Find the k-th smallest value in each row of a matrix, and whether
+    the (k+1)-th smallest value is tied with it, so that a row's k
+    nearest neighbors are exactly the entries at most its threshold
+    unless it has a tie
+    :param D: MxN matrix
+    :param k: Number of neighbors, between 1 and N
+    :param NIndexV: (Optional) Sorted values of the nearest neighbors
+        of each row (RowV of getNeighborIndex), used if it has at least
+        k+1 of them (or all N)
+    :param RowsPerChunk: Number of rows to partition at a time
+    :returns (T, Ties): M array of thresholds and M boolean array of ties
+    """
+    (M, N) = D.shape
+    if NIndexV is not None and NIndexV.shape[1] >= min(k+1, N):
+        T = NIndexV[:, k-1]
+        if k < N:
+            return (T, NIndexV[:, k] == T)
+        return (T, np.zeros(M, dtype=bool))
+    T = np.zeros(M, dtype=D.dtype)
+    Ties = np.zeros(M, dtype=bool)
+    for i1 in range(0, M, RowsPerChunk):
+        i2 = min(i1+RowsPerChunk, M)
+        P = np.partition(D[i1:i2, :], k-1, 1)
+        T[i1:i2] = P[:, k-1]
+        #The (k+1)-th smallest is the smallest of the rest, which is
+        #cheaper to find than partitioning at two places
+        if k < N:
+            Ties[i1:i2] = np.min(P[:, k::], 1) == P[:, k-1]
+    return (T, Ties)
+
+def getMutualNeighborsMask(D, Kappa, NIndex = None, RowsPerChunk = 1000):
+    """
+    Return a boolean matrix which is True wherever an entry of D is
+    among the nearest neighbors of both its row and its column.  This
+    is done by finding the k-th order threshold of every row and every
+    column and then comparing each block of rows to both thresholds at
+    once.  Rows and columns whose thresholds are tied fall back on the
+    exact neighbor sets of getBinaryNeighborsMask, so the result is the
+    same as taking the AND of the two directions
+    :param D: MxN cross-similarity matrix
+    :param Kappa: (as in CSMToBinary)
+    :param NIndex: (Optional) getNeighborIndex of D.  It's used for the
+        thresholds if it has at least one more neighbor per row and
+        per column than Kappa needs
+    :param RowsPerChunk: Number of rows to do at a time
+    :returns B: MxN boolean matrix
+    """
+    (M, N) = D.shape
     if Kappa == 0:
-        return np.ones((N, M))
-    elif Kappa < 1:
-        NNeighbs = int(np.round(Kappa*M))
-    else:
-        NNeighbs = Kappa
-    J = np.argpartition(D, NNeighbs, 1)[:, 0:NNeighbs]
-    I = np.tile(np.arange(N)[:, None], (1, NNeighbs))
-    V = np.ones(I.size)
-    [I, J] = [I.flatten(), J.flatten()]
-    ret = sparse.coo_matrix((V, (I, J)), shape=(N, M))
-    return ret.toarray()
+        return np.ones((M, N), dtype=bool)
+    (kr, kc) = (getBinaryNeighbors(N, Kappa), getBinaryNeighbors(M, Kappa))
+    if kr == 0 or kc == 0:
+        return np.zeros((M, N), dtype=bool)
+    (RowV, ColV, RowJ, ColJ) = (None, None, None, None)
+    if NIndex is not None:
+        (RowV, ColV, RowJ, ColJ) = (NIndex['RowV'], NIndex['ColV'], NIndex['RowJ'], NIndex['ColJ'])
+    (TR, RowTies) = getKthThresholds(D, kr, RowV, RowsPerChunk)
+    (TC, ColTies) = getKthThresholds(D.T, kc, ColV, RowsPerChunk)
+    B = np.empty((M, N), dtype=bool)
+    for i1 in range(0, M, RowsPerChunk):
+        i2 = min(i1+RowsPerChunk, M)
+        np.less_equal(D[i1:i2, :], TR[i1:i2, None], out=B[i1:i2, :])
+        B[i1:i2, :] &= D[i1:i2, :] <= TC[None, :]
+    #Fix up the rows and columns with ties
+    I = np.flatnonzero(RowTies)
+    if I.size > 0:
+        BR = getBinaryNeighborsMask(D[I, :], Kappa, None if RowJ is None else {'RowJ':RowJ[I]})
+        B[I, :] = BR & (D[I, :] <= TC[None, :])
+    J = np.flatnonzero(ColTies)
+    if J.size > 0:
+        BC = getBinaryNeighborsMask(D[:, J].T, Kappa, None if ColJ is None else {'RowJ':ColJ[J]}).T
+        BR = D[:, J] <= TR[:, None]
+        if I.size > 0:
+            BR[I, :] = getBinaryNeighborsMask(D[I, :], Kappa, None if RowJ is None else {'RowJ':RowJ[I]})[:, J]
+        B[:, J] = BR & BC
+    return B
 
-def CSMToBinaryMutual(D, Kappa):
+def CSMToBinaryMutual(D, Kappa, NIndex = None, packed = False, coo = False):
     """
     Take the binary AND between the nearest neighbors in one
     direction and the other
     :param D: MxN cross-similarity matrix
     :param Kappa: (as in CSMToBinary)
+    :param NIndex: (Optional) getNeighborIndex of D (see
+        getMutualNeighborsMask)
+    :param packed: If True, return a PackedCSM instead of a dense matrix
+    :param coo: If True, return a sparse COO matrix instead of a
+        dense matrix
     :returns B: MxN mutual binary cross-similarity matrix
     """
-    B1 = CSMToBinary(D, Kappa)
-    B2 = CSMToBinary(D.T, Kappa).T
-    return B1*B2
+    B = getMutualNeighborsMask(D, Kappa, NIndex)
+    if packed:
+        return PackedCSM(np.packbits(B, axis=1), B.shape)
+    if coo:
+        [I, J] = np.nonzero(B)
+        return sparse.coo_matrix((np.ones(I.size), (I, J)), shape=B.shape)
+    return np.array(B, dtype=np.float64)
 
 def getCSMType(Features1, O1, Features2, O2, Type):
     """
@@ -224,6 +501,8 @@ def getCSMType(Features1, O1, Features2, O2, Type):
         return getCSMCosine(Features1, Features2)
     elif Type == "CosineOTI":
         return getCSMCosineOTI(Features1, Features2, O1['ChromaMean'], O2['ChromaMean'])
+    elif Type == "CosineLocalOTI":
+        return getCSMCosineAllOTI(Features1, Features2, O1['ChromaMean'], O2['ChromaMean'])[1]
     elif Type == "EMD1D":
         return getCSMEMD1D(Features1, Features2)
     print("Error: Unknown CSM type ", Type)
@@ -250,7 +529,7 @@ def getCSMSmithWatermanScores(Features1, O1, Features2, O2, Kappa, Type, doPlot
         if doPlot is True
     """
     CSM = getCSMType(Features1, O1, Features2, O2, Type)
-    DBinary = CSMToBinaryMutual(CSM, Kappa)
+    DBinary = CSMToBinaryMutual(CSM, Kappa, packed = not doPlot)
     if doPlot:
         (maxD, D) = SA.swalignimpconstrained(DBinary)
         plt.subplot(131)
@@ -263,7 +542,7 @@ def getCSMSmithWatermanScores(Features1, O1, Features2, O2, Kappa, Type, doPlot
         plt.imshow(D, interpolation = 'nearest', cmap = 'afmhot')
         plt.title("Smith Waterman Score = %g"%maxD)
         return {'score':maxD, 'DBinary':DBinary, 'D':D, 'maxD':maxD, 'CSM':CSM}
-    return SAC.swalignimpconstrained(DBinary)
+    return getSWScore(DBinary)
 
 ######################################################
 ##        Early OR Merge Smith Waterman Tests       ##
@@ -294,37 +573,40 @@ def getCSMSmithWatermanScoresORMerge(AllFeatures1, O1, AllFeatures2, O2, Kappa,
     for i in range(len(Features)):
         F = Features[i]
         CSMs.append(getCSMType(AllFeatures1[F], O1, AllFeatures2[F], O2, CSMTypes[F]))
-        DsBinary.append(CSMToBinaryMutual(CSMs[i], Kappa))
+        DsBinary.append(CSMToBinaryMutual(CSMs[i], Kappa, packed = not doPlot))
     #Do an OR merge
+    if not doPlot:
+        DBinary = DsBinary[0]
+        for D in DsBinary[1::]:
+            DBinary = DBinary | D
+        return getSWScore(DBinary)
     DBinary = np.zeros(DsBinary[0].shape)
     for D in DsBinary:
         DBinary += D
     DBinary[DBinary > 0] = 1
-    if doPlot:
-        #TODO: I have no idea why I'm seeing a large gap
-        (maxD, D) = SA.swalignimpconstrained(DBinary)
-        N = len(CSMs)
-        for i in range(N):
-            print("plt.subplot(2, %i, %i)"%(N+1, i+1))
-            plt.subplot(2, N+1, i+1)
-            plt.imshow(CSMs[i], interpolation = 'nearest', cmap = 'afmhot')
-            plt.title('CSM %s'%Features[i])
-            plt.subplot(2, N+1, N+2+i)
-            plt.imshow(1-DsBinary[i], interpolation = 'nearest', cmap = 'gray')
-            plt.title("CSM Binary %s K=%g"%(Features[i], Kappa))
-        plt.subplot(2, N+1, 2*N+2)
-        plt.imshow(DBinary, interpolation = 'nearest', cmap = 'afmhot')
-        plt.title('CSM Binary OR Merged')
-        plt.subplot(2, N+1, N+1)
-        plt.imshow(D, interpolation = 'nearest', cmap = 'afmhot')
-        plt.title("Smith Waterman Score = %g"%maxD)
-        return {'score':maxD, 'DBinary':DBinary, 'D':D, 'maxD':maxD}
-    return SAC.swalignimpconstrained(DBinary)
+    #TODO: I have no idea why I'm seeing a large gap
+    (maxD, D) = SA.swalignimpconstrained(DBinary)
+    N = len(CSMs)
+    for i in range(N):
+        print("plt.subplot(2, %i, %i)"%(N+1, i+1))
+        plt.subplot(2, N+1, i+1)
+        plt.imshow(CSMs[i], interpolation = 'nearest', cmap = 'afmhot')
+        plt.title('CSM %s'%Features[i])
+        plt.subplot(2, N+1, N+2+i)
+        plt.imshow(1-DsBinary[i], interpolation = 'nearest', cmap = 'gray')
+        plt.title("CSM Binary %s K=%g"%(Features[i], Kappa))
+    plt.subplot(2, N+1, 2*N+2)
+    plt.imshow(DBinary, interpolation = 'nearest', cmap = 'afmhot')
+    plt.title('CSM Binary OR Merged')
+    plt.subplot(2, N+1, N+1)
+    plt.imshow(D, interpolation = 'nearest', cmap = 'afmhot')
+    plt.title("Smith Waterman Score = %g"%maxD)
+    return {'score':maxD, 'DBinary':DBinary, 'D':D, 'maxD':maxD}
 
 ######################################################
 ##          Early Fusion Smith Waterman Tests       ##
 ######################################################
-def getCSMSmithWatermanScoresEarlyFusionFull(AllFeatures1, O1, AllFeatures2, O2, Kappa, K, NIters, CSMTypes, doPlot = False, conservative = False):
+def getCSMSmithWatermanScoresEarlyFusionFull(AllFeatures1, O1, AllFeatures2, O2, Kappa, K, NIters, CSMTypes, doPlot = False, conservative = False, NThreads = 1):
     """
     Compute the Smith Waterman score between two songs
     after doing early similarity network fusion on
@@ -343,6 +625,8 @@ def getCSMSmithWatermanScoresEarlyFusionFull(AllFeatures1, O1, AllFeatures2, O2,
     :param conservative: Whether to use a percentage of the
         closest distances instead of mutual nearest neighbors
         (False by default, but useful for audio synchronization)
+    :param NThreads: Number of threads with which to diffuse the
+        feature views concurrently in similarity fusion
     :returns:
         if doPlot = False
             {'score', 'CSM', 'DBinary', 'OtherCSMs'}
@@ -364,7 +648,7 @@ def getCSMSmithWatermanScoresEarlyFusionFull(AllFeatures1, O1, AllFeatures2, O2,
         #Build W from CSM and SSMs
         Ws.append(getWCSMSSM(SSMA, SSMB, CSMAB, K))
     tic = time.time()
-    D = doSimilarityFusionWs(Ws, K, NIters, 1)
+    D = doSimilarityFusionWs(Ws, K, NIters, 1, NThreads = NThreads)
     toc = time.time()
     t1 = toc - tic
     N = AllFeatures1[Features[0]].shape[0]
@@ -49,7 +49,7 @@ def pretty_floats(obj):
         return map(pretty_floats, obj)
     return obj
 
-def compareTwoSongsJSON(filename1, TempoBias1, filename2, TempoBias2, hopSize, FeatureParams, CSMTypes, Kappa, outfilename, song1name = 'Song 1', song2name = 'Song 2'):
+def compareTwoSongsJSON(filename1, TempoBias1, filename2, TempoBias2, hopSize, FeatureParams, CSMTypes, Kappa, outfilename, song1name = 'Song 1', song2name = 'Song 2', NThreads = 1):
     print("Getting features for %s..."%filename1)
     (XAudio, Fs) = getAudioLibrosa(filename1)
     (tempo, beats1) = getBeats(XAudio, Fs, TempoBias1, hopSize, filename1)
@@ -92,7 +92,7 @@ def compareTwoSongsJSON(filename1, TempoBias1, filename2, TempoBias2, hopSize, F
     print("Doing similarity network fusion...")
     K = 20
     NIters = 3
-    res = getCSMSmithWatermanScoresEarlyFusionFull(Features1, O1, Features2, O2, Kappa, K, NIters, CSMTypes, True)
+    res = getCSMSmithWatermanScoresEarlyFusionFull(Features1, O1, Features2, O2, Kappa, K, NIters, CSMTypes, True, NThreads = NThreads)
     CSMs = {}
     CSMs['D'] = getBase64PNGImage(res['D'], 'afmhot')
     CSMs['CSM'] = getBase64PNGImage(res['CSM'], 'afmhot')
@@ -128,9 +128,10 @@ if __name__ == '__main__':
     parser.add_argument('--tempobias2', type=int, default=120, help="Tempo bias of the beat tracker for the second song")
     parser.add_argument('--hopsize', type=int, default=512, help="Hop size to use for the features")
     parser.add_argument('--kappa', type=float, default=0.1, help="Nearest neighbor threshold")
+    parser.add_argument('--nthreads', type=int, default=1, help="Number of threads to use in similarity network fusion")
     opt = parser.parse_args()
 
     FeatureParams = {'MFCCBeatsPerBlock':20, 'MFCCSamplesPerBlock':200, 'DPixels':50, 'ChromaBeatsPerBlock':20, 'ChromasPerBlock':40}
     CSMTypes = {'MFCCs':'Euclidean', 'SSMs':'Euclidean', 'SSMsDiffusion':'Euclidean', 'Geodesics':'Euclidean', 'Jumps':'Euclidean', 'Curvs':'Euclidean', 'Tors':'Euclidean', 'CurvsSS':'Euclidean', 'TorsSS':'Euclidean', 'D2s':'EMD1D', 'Chromas':'CosineOTI'}
 
-    compareTwoSongsJSON(opt.filename1, opt.tempobias1, opt.filename2, opt.tempobias2, opt.hopsize, FeatureParams, CSMTypes, opt.kappa, opt.jsonfilename, opt.artist1, opt.artist2)
+    compareTwoSongsJSON(opt.filename1, opt.tempobias1, opt.filename2, opt.tempobias2, opt.hopsize, FeatureParams, CSMTypes, opt.kappa, opt.jsonfilename, opt.artist1, opt.artist2, opt.nthreads)
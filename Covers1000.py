@@ -248,5 +248,5 @@ if __name__ == '__main__':
     else:
         #Compute features in a block
         allFiles = ["%s.wav"%s for s in AllSongs]
-        ranges = getBatchBlockRanges(1000, NPerBatch)
+        ranges = getBatchBlockRangesTriangular(1000, NPerBatch)
         compareBatchBlock((ranges[BatchNum], Kappa, CSMTypes, allFiles, scratchDir))
@@ -62,22 +62,34 @@ if __name__ == '__main__':
     parpool = PPool(NThreads)
 
     #Precompute beat intervals, MFCC, and HPCP Features for each song
+    CacheParams = {'hopSize':hopSize, 'Kappa':Kappa, 'CSMTypes':CSMTypes, 'FeatureParams':FeatureParams, 'TempoLevels':TempoLevels}
+    FeatureFiles = resolveFeatureCache(scratchDir, allFiles, CacheParams, parpool)
     NF = len(allFiles)
-    args = zip(allFiles, [scratchDir]*NF, [hopSize]*NF, [Kappa]*NF, [CSMTypes]*NF, [FeatureParams]*NF, [TempoLevels]*NF, [{}]*NF)
+    args = zip(allFiles, [scratchDir]*NF, [hopSize]*NF, [Kappa]*NF, [CSMTypes]*NF, [FeatureParams]*NF, [TempoLevels]*NF, [{}]*NF, FeatureFiles)
     parpool.map(precomputeBatchFeatures, args)
+    #Pack all features into one memory mapped file that the block
+    #workers can share
+    packFeatureStore(scratchDir, FeatureFiles)
 
     #Process blocks of similarity at a time
     N = len(allFiles)
     NPerBlock = 20
-    ranges = getBatchBlockRanges(N, NPerBlock)
-    args = zip(ranges, [Kappa]*len(ranges), [CSMTypes]*len(ranges), [allFiles]*len(ranges), [scratchDir]*len(ranges))
-    res = parpool.map(compareBatchBlock, args)
+    Beats = getBatchSongBeats(allFiles, scratchDir, FeatureFiles)
+    ranges = getBatchBlockRangesTriangular(N, NPerBlock, Beats)
+    ranges = scheduleBatchBlocks(ranges, Beats)
+    BlockParams = {'FeatureFiles':FeatureFiles}
+    args = zip(ranges, [Kappa]*len(ranges), [CSMTypes]*len(ranges), [allFiles]*len(ranges), [scratchDir]*len(ranges), [BlockParams]*len(ranges))
+    res = parpool.map(compareBatchBlock, args, chunksize = 1)
     Ds = assembleBatchBlocks(list(CSMTypes) + ['SNF'], res, ranges, N)
 
     #Perform late fusion
     Scores = [1.0/Ds[F] for F in Ds.keys()]
     Ds['Late'] = doSimilarityFusion(Scores, 20, 20, 1)
 
+    #Mark the features as used now, so garbage collection by age
+    #doesn't count the time this run took against them
+    touchFeatureCache(scratchDir, FeatureFiles)
+
     #Write results to disk
     sio.savemat("%s.mat"%filePrefix, Ds)
     fout = open("Covers80Results_%g_%s.html"%(Kappa, BeatsPerBlock), "w")
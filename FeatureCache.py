@@ -0,0 +1,336 @@
+"""
+Purpose: A content-addressed cache of precomputed batch features.
+Each song's features are saved under a key made from a hash of the
+audio file contents and a hash of every parameter that affects the
+features, so songs with the same name in different folders never
+collide and changing a parameter never silently reuses stale features.
+A manifest records what every cache entry is and when it was last used,
+so that entries which are no longer needed can be garbage collected.
+Updates to the manifest are serialized with a lock file, since one
+scratch directory may be shared by several experiments at once
+"""
+import hashlib
+import json
+import os
+import socket
+import time
+from sys import exit, argv
+
+#A manifest lock older than this many seconds was left by a process
+#that died, since updating the manifest only takes a moment
+MANIFEST_LOCK_SECONDS = 600
+
+def getFeatureCacheDir(scratchDir):
+    return "%s/features"%scratchDir
+
+def getManifestLockOwner():
+    return "%s_%i"%(socket.gethostname(), os.getpid())
+
+def createLockFile(lockfile, owner):
+    """
+    Try to create a lock file exclusively, holding the name of its owner
+    :returns: True if this call created it, or False if it already exists
+    """
+    try:
+        fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(fd, owner.encode('utf-8'))
+    os.close(fd)
+    return True
+
+def getLockFileOwner(lockfile):
+    """
+    Return the owner written in a lock file, or None if there is no lock
+    """
+    try:
+        fin = open(lockfile, 'r')
+        owner = fin.read()
+        fin.close()
+    except FileNotFoundError:
+        return None
+    return owner
+
+def isLockFileStale(lockfile):
+    """
+    Return whether a lock file hasn't changed in MANIFEST_LOCK_SECONDS
+    """
+    try:
+        return time.time() - os.path.getmtime(lockfile) > MANIFEST_LOCK_SECONDS
+    except FileNotFoundError:
+        return False
+
+def breakFeatureCacheManifestLock(lockfile):
+    """
+    Remove a stale manifest lock.  Only one process at a time may break
+    the lock, and it checks that the lock is still stale once it has the
+    right to, so that a lock which was just broken and taken again by
+    someone else is never removed as well
+    :param lockfile: Path to the manifest lock
+    """
+    breakfile = "%s.break"%lockfile
+    if not createLockFile(breakfile, getManifestLockOwner()):
+        #Breaking only takes a moment, so if this is stale, the
+        #process that was breaking the lock died
+        if isLockFileStale(breakfile):
+            try:
+                os.remove(breakfile)
+            except FileNotFoundError:
+                pass
+        return
+    try:
+        if isLockFileStale(lockfile):
+            os.remove(lockfile)
+            print("Broke expired lock on feature cache manifest")
+    finally:
+        os.remove(breakfile)
+
+def lockFeatureCacheManifest(scratchDir, pollSeconds = 0.1):
+    """
+    Wait until this process holds the lock on the manifest, so that
+    experiments sharing one scratch directory never lose each other's
+    updates.  The lock is a file created exclusively, holding the name
+    of its owner, which is read back to make sure the lock wasn't broken
+    in the meantime.  A lock that hasn't changed in MANIFEST_LOCK_SECONDS
+    was left by a process that died, and it is broken
+    (see breakFeatureCacheManifestLock)
+    :param scratchDir: Path to scratch directory
+    :param pollSeconds: How long to wait between tries
+    """
+    lockfile = "%s/manifest.lock"%getFeatureCacheDir(scratchDir)
+    owner = getManifestLockOwner()
+    while True:
+        if createLockFile(lockfile, owner):
+            if getLockFileOwner(lockfile) == owner:
+                return
+            continue
+        if isLockFileStale(lockfile):
+            breakFeatureCacheManifestLock(lockfile)
+            continue
+        time.sleep(pollSeconds)
+
+def unlockFeatureCacheManifest(scratchDir):
+    """
+    Release the lock on the manifest, if this process still holds it
+    """
+    lockfile = "%s/manifest.lock"%getFeatureCacheDir(scratchDir)
+    if getLockFileOwner(lockfile) == getManifestLockOwner():
+        os.remove(lockfile)
+
+def getFeatureParamsHash(Params):
+    """
+    Hash a dictionary of feature parameters in a way that does not
+    depend on the order of the keys
+    :param Params: Dictionary of parameters (hopSize, Kappa, CSMTypes,
+        FeatureParams, TempoLevels)
+    :returns: A hex digest string
+    """
+    s = json.dumps(Params, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def getAudioContentHash(filename):
+    """
+    Hash the contents of an audio file.  If the file doesn't exist
+    (e.g. Covers1000, where a dummy filename stands in for features
+    that were computed elsewhere), hash the path instead
+    :param filename: Path to audio file
+    :returns: A hex digest string
+    """
+    h = hashlib.sha1()
+    if not os.path.exists(filename):
+        h.update(("path:%s"%filename).encode('utf-8'))
+        return h.hexdigest()
+    fin = open(filename, 'rb')
+    chunk = fin.read(1 << 20)
+    while len(chunk) > 0:
+        h.update(chunk)
+        chunk = fin.read(1 << 20)
+    fin.close()
+    return h.hexdigest()
+
+def loadFeatureCacheManifest(scratchDir):
+    """
+    Load the manifest of the feature cache, which holds
+        'entries': {key: {'audio', 'params', 'lastUsed'}}
+        'params': {paramshash: Params}
+        'audio': {abspath: {'size', 'mtime', 'hash'}}
+    where the last one memoizes audio hashes so files are
+    only read again if they change
+    """
+    filename = "%s/manifest.json"%getFeatureCacheDir(scratchDir)
+    if not os.path.exists(filename):
+        return {'entries':{}, 'params':{}, 'audio':{}}
+    fin = open(filename, 'r')
+    Manifest = json.load(fin)
+    fin.close()
+    return Manifest
+
+def saveFeatureCacheManifest(scratchDir, Manifest):
+    """
+    Atomically replace the manifest.  This should only be called
+    while holding the lock from lockFeatureCacheManifest
+    """
+    filename = "%s/manifest.json"%getFeatureCacheDir(scratchDir)
+    tmpfilename = "%s.%s.tmp"%(filename, getManifestLockOwner())
+    fout = open(tmpfilename, 'w')
+    json.dump(Manifest, fout, indent=1)
+    fout.close()
+    os.replace(tmpfilename, filename)
+
+def resolveFeatureCache(scratchDir, allFiles, Params, parpool = None):
+    """
+    Figure out the cache filename for the features of every song,
+    and record all of them as used now in the manifest.  Audio hashes
+    are reused from the manifest for files whose size and modification
+    time haven't changed.  New audio files are hashed without holding
+    the manifest lock, and the results are merged into the latest
+    manifest under the lock
+    :param scratchDir: Path to scratch directory
+    :param allFiles: List of paths to audio files
+    :param Params: Dictionary of every parameter that affects the
+        features (hopSize, Kappa, CSMTypes, FeatureParams, TempoLevels)
+    :param parpool: If specified, a pool with which to hash new
+        audio files in parallel
+    :returns FeatureFiles: List of .mat filenames, parallel with allFiles
+    """
+    cacheDir = getFeatureCacheDir(scratchDir)
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+    Manifest = loadFeatureCacheManifest(scratchDir)
+    ParamsHash = getFeatureParamsHash(Params)
+
+    #Hash all audio files that are new or have changed
+    stats = {}
+    toHash = []
+    for f in allFiles:
+        path = os.path.abspath(f)
+        stats[path] = [0, 0]
+        if os.path.exists(path):
+            st = os.stat(path)
+            stats[path] = [st.st_size, st.st_mtime]
+        if path in Manifest['audio']:
+            memo = Manifest['audio'][path]
+            if [memo['size'], memo['mtime']] == stats[path]:
+                continue
+        toHash.append(f)
+    toHash = sorted(set(toHash))
+    AudioHashes = {}
+    for f in allFiles:
+        path = os.path.abspath(f)
+        if path in Manifest['audio']:
+            AudioHashes[path] = Manifest['audio'][path]
+    if len(toHash) > 0:
+        print("Hashing %i audio files..."%len(toHash))
+        if parpool:
+            hashes = parpool.map(getAudioContentHash, toHash)
+        else:
+            hashes = [getAudioContentHash(f) for f in toHash]
+        for f, h in zip(toHash, hashes):
+            path = os.path.abspath(f)
+            AudioHashes[path] = {'size':stats[path][0], 'mtime':stats[path][1], 'hash':h}
+
+    FeatureFiles = []
+    lockFeatureCacheManifest(scratchDir)
+    try:
+        #Another experiment may have updated the manifest in the meantime
+        Manifest = loadFeatureCacheManifest(scratchDir)
+        Manifest['params'][ParamsHash] = Params
+        Manifest['audio'].update(AudioHashes)
+        now = time.time()
+        for f in allFiles:
+            AudioHash = AudioHashes[os.path.abspath(f)]['hash']
+            key = "%s_%s"%(AudioHash[0:20], ParamsHash[0:12])
+            Manifest['entries'][key] = {'audio':f, 'params':ParamsHash, 'lastUsed':now}
+            FeatureFiles.append("%s/%s.mat"%(cacheDir, key))
+        saveFeatureCacheManifest(scratchDir, Manifest)
+    finally:
+        unlockFeatureCacheManifest(scratchDir)
+    return FeatureFiles
+
+def touchFeatureCache(scratchDir, FeatureFiles):
+    """
+    Record the cache entries of an experiment as used now.  This should
+    be called when an experiment finishes, as well as when it starts
+    (resolveFeatureCache), so that garbage collection by age never
+    deletes the features of a long experiment
+    :param scratchDir: Path to scratch directory
+    :param FeatureFiles: List of .mat filenames from resolveFeatureCache
+    """
+    lockFeatureCacheManifest(scratchDir)
+    try:
+        Manifest = loadFeatureCacheManifest(scratchDir)
+        now = time.time()
+        for f in FeatureFiles:
+            key = os.path.basename(f)[0:-4]
+            if key in Manifest['entries']:
+                Manifest['entries'][key]['lastUsed'] = now
+        saveFeatureCacheManifest(scratchDir, Manifest)
+    finally:
+        unlockFeatureCacheManifest(scratchDir)
+
+def collectFeatureCacheGarbage(scratchDir, keepParams = None, maxAgeDays = None):
+    """
+    Delete the cache entries that are no longer needed, along with
+    their .mat files.  Only entries whose own records say they should
+    go are deleted; .mat files that the manifest doesn't know about
+    are left alone, since they may belong to an experiment that is
+    computing them right now.  If anything was deleted, the packed
+    feature store is also removed, since it may refer to deleted
+    entries; it gets rebuilt from the remaining .mat files the next
+    time it is packed
+    :param scratchDir: Path to scratch directory
+    :param keepParams: If specified, a list of parameter dictionaries
+        whose entries should be kept; all others are deleted
+    :param maxAgeDays: If specified, delete entries that haven't
+        been used in this many days.  This should be longer than the
+        longest experiment, since entries are only marked as used when
+        an experiment starts and when it finishes (see touchFeatureCache)
+    :returns: The number of .mat files deleted
+    """
+    from FeatureStore import getFeatureStorePaths
+    cacheDir = getFeatureCacheDir(scratchDir)
+    if not os.path.exists(cacheDir):
+        print("Removed 0 cached feature files")
+        return 0
+    keepHashes = None
+    if keepParams is not None:
+        keepHashes = set([getFeatureParamsHash(P) for P in keepParams])
+    count = 0
+    lockFeatureCacheManifest(scratchDir)
+    try:
+        Manifest = loadFeatureCacheManifest(scratchDir)
+        now = time.time()
+        for key in list(Manifest['entries'].keys()):
+            entry = Manifest['entries'][key]
+            expired = maxAgeDays is not None and now - entry['lastUsed'] > maxAgeDays*24*3600
+            if expired or (keepHashes is not None and not entry['params'] in keepHashes):
+                del Manifest['entries'][key]
+                filename = "%s/%s.mat"%(cacheDir, key)
+                if os.path.exists(filename):
+                    os.remove(filename)
+                    count += 1
+        #Drop parameter sets and audio hashes that nothing refers to anymore
+        usedParams = set([e['params'] for e in Manifest['entries'].values()])
+        for h in list(Manifest['params'].keys()):
+            if not h in usedParams:
+                del Manifest['params'][h]
+        for path in list(Manifest['audio'].keys()):
+            if not os.path.exists(path):
+                del Manifest['audio'][path]
+        saveFeatureCacheManifest(scratchDir, Manifest)
+        #Remove the store while still holding the lock, so it's never
+        #removed in the middle of being packed
+        if count > 0:
+            for f in reversed(getFeatureStorePaths(scratchDir)):
+                if os.path.exists(f):
+                    os.remove(f)
+    finally:
+        unlockFeatureCacheManifest(scratchDir)
+    print("Removed %i cached feature files"%count)
+    return count
+
+if __name__ == '__main__':
+    if len(argv) < 3:
+        print("Usage: python FeatureCache.py <scratchDir> <maxAgeDays>")
+        exit(0)
+    collectFeatureCacheGarbage(argv[1], maxAgeDays = float(argv[2]))
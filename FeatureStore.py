@@ -0,0 +1,171 @@
+"""
+Purpose: A packed, memory-mapped store of precomputed song features
+for batch comparisons.  All of the arrays for every song are written
+back to back into one flat binary file, next to a JSON index of the
+offset, shape, and type of each array.  Pool workers map the file once
+and slice features out of it without copying or unpickling anything,
+and the operating system shares the pages between all of them
+"""
+import numpy as np
+import scipy.io as sio
+import json
+import os
+from FeatureCache import getFeatureCacheDir, lockFeatureCacheManifest, unlockFeatureCacheManifest
+
+#Byte alignment of every array in the packed file
+STORE_ALIGNMENT = 64
+
+#Stores that have already been opened in this process, by directory
+OpenStores = {}
+
+def getFeatureStorePaths(scratchDir):
+    """
+    Return the paths to the packed binary file and to its index
+    :param scratchDir: Path to the directory holding the store
+    :returns (binfilename, indexfilename)
+    """
+    return ("%s/Features.bin"%scratchDir, "%s/Features.json"%scratchDir)
+
+def getFeatureStoreKey(matfilename):
+    """
+    Return the key under which the features from a .mat file
+    are indexed in the store
+    """
+    return os.path.basename(matfilename)
+
+def getFeatureStoreEnd(Index):
+    """
+    Return the number of bytes of the binary file that an index refers to
+    """
+    end = 0
+    for entry in Index.values():
+        for arr in entry.values():
+            if 'offset' in arr:
+                nbytes = int(np.prod(arr['shape']))*np.dtype(arr['dtype']).itemsize
+                end = max(end, arr['offset'] + nbytes)
+    return end
+
+def packFeatureStore(scratchDir, matfilenames):
+    """
+    Append the features saved in a list of .mat files to the packed
+    store in scratchDir, skipping files that are already in there.
+    Scalars are kept in the index itself, and every other array is
+    written to the binary file in C order.  The whole pack happens
+    under the feature cache manifest lock, so that experiments sharing
+    a scratch directory never interleave their writes or lose each
+    other's entries in the index
+    :param scratchDir: Path to the directory holding the store
+    :param matfilenames: Paths to .mat files of precomputed features
+    """
+    (binfilename, indexfilename) = getFeatureStorePaths(scratchDir)
+    cacheDir = getFeatureCacheDir(scratchDir)
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+    lockFeatureCacheManifest(scratchDir)
+    try:
+        Index = {}
+        if os.path.exists(indexfilename):
+            fin = open(indexfilename, 'r')
+            Index = json.load(fin)
+            fin.close()
+        #If the binary file was removed or cut short (e.g. by garbage
+        #collection), the index can't be trusted, so start over
+        if not os.path.exists(binfilename) or os.path.getsize(binfilename) < getFeatureStoreEnd(Index):
+            Index = {}
+            #Make a new file rather than truncating one that other
+            #processes may still have mapped
+            if os.path.exists(binfilename):
+                os.remove(binfilename)
+            open(binfilename, 'wb').close()
+        fout = open(binfilename, 'ab')
+        fout.seek(0, 2)
+        offset = fout.tell()
+        count = 0
+        for filename in matfilenames:
+            key = getFeatureStoreKey(filename)
+            if key in Index or not os.path.exists(filename):
+                continue
+            entry = {}
+            for name, val in sio.loadmat(filename).items():
+                if name.startswith('__') or not type(val) is np.ndarray:
+                    continue
+                if val.size == 1:
+                    entry[name] = {'value':val.flatten()[0].item()}
+                    continue
+                pad = (-offset)%STORE_ALIGNMENT
+                fout.write(b'\0'*pad)
+                offset += pad
+                val = np.ascontiguousarray(val)
+                fout.write(val.tobytes())
+                entry[name] = {'offset':offset, 'shape':list(val.shape), 'dtype':val.dtype.str}
+                offset += val.nbytes
+            Index[key] = entry
+            count += 1
+        fout.flush()
+        os.fsync(fout.fileno())
+        fout.close()
+        #Replace the index atomically so that readers never see a partial one
+        fout = open("%s.tmp"%indexfilename, 'w')
+        json.dump(Index, fout)
+        fout.close()
+        os.replace("%s.tmp"%indexfilename, indexfilename)
+    finally:
+        unlockFeatureCacheManifest(scratchDir)
+    print("Packed %i new songs into feature store (%i total)"%(count, len(Index)))
+
+def openFeatureStore(scratchDir):
+    """
+    Memory map the feature store in scratchDir.  This only happens once
+    per process, unless the index has been rewritten since
+    :param scratchDir: Path to the directory holding the store
+    :returns Store: A dictionary {'Index', 'Data', 'mtime'}, or None
+        if there is no store in this directory, or if its binary file
+        is missing or doesn't hold everything in the index
+    """
+    (binfilename, indexfilename) = getFeatureStorePaths(scratchDir)
+    try:
+        mtime = os.path.getmtime(indexfilename)
+        size = os.path.getsize(binfilename)
+        if scratchDir in OpenStores and OpenStores[scratchDir]['mtime'] == mtime:
+            return OpenStores[scratchDir]
+        fin = open(indexfilename, 'r')
+        Index = json.load(fin)
+        fin.close()
+    except FileNotFoundError:
+        #Either there is no store, or garbage collection removed it
+        OpenStores.pop(scratchDir, None)
+        return None
+    if size < getFeatureStoreEnd(Index):
+        OpenStores.pop(scratchDir, None)
+        return None
+    if size > 0:
+        Data = np.memmap(binfilename, dtype=np.uint8, mode='r')
+    else:
+        Data = np.zeros(0, dtype=np.uint8)
+    OpenStores[scratchDir] = {'Index':Index, 'Data':Data, 'mtime':mtime}
+    return OpenStores[scratchDir]
+
+def getStoreFeatures(Store, matfilename):
+    """
+    Get all of the features of one song out of the store as read-only
+    views into the memory map.  Scalars are returned as python numbers,
+    just as compareBatchBlock unpacks them from a .mat file
+    :param Store: A store returned from openFeatureStore
+    :param matfilename: Path of the .mat file the features came from
+    :returns Features: Dictionary of features, or None if this song
+        is not in the store
+    """
+    key = getFeatureStoreKey(matfilename)
+    if not key in Store['Index']:
+        return None
+    Features = {}
+    for name, entry in Store['Index'][key].items():
+        if 'value' in entry:
+            Features[name] = entry['value']
+            continue
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        start = entry['offset']
+        Features[name] = Store['Data'][start:start+nbytes].view(dtype).reshape(shape)
+    return Features
@@ -0,0 +1,355 @@
+"""
+Purpose: A job queue that lives in a directory on a shared file system,
+so that any number of worker processes on any number of machines that
+can see the directory can pull tasks from it, without a scheduler
+service.  Each task is a pickled function name and argument tuple.
+A worker claims a task by exclusively creating a lock file for it, and
+holds a lease on it by touching the lock file while the task runs.  If
+a worker dies, its lease expires and another worker breaks the lock and
+retries the task, up to a maximum number of attempts.  Since a task may
+end up running more than once, tasks must be idempotent; compareBatchBlock
+and precomputeBatchFeatures both are, since they write their results to
+a temporary file of their own and atomically rename it into place, and
+skip work whose results already exist
+"""
+import os
+import pickle
+import hashlib
+import importlib
+import socket
+import threading
+import traceback
+import time
+from multiprocessing import Process
+from sys import exit, argv, stdout
+
+def getQueueWorkerName():
+    return "%s_%i"%(socket.gethostname(), os.getpid())
+
+def getQueueDirs(queueDir):
+    """
+    Return the subdirectories of a queue
+    :returns (tasksDir, locksDir, attemptsDir, doneDir, failedDir)
+    """
+    return tuple(["%s/%s"%(queueDir, s) for s in ['tasks', 'locks', 'attempts', 'done', 'failed']])
+
+def saveQueueFile(filename, data):
+    """
+    Atomically write bytes to a file, so that no other worker
+    ever sees part of it
+    """
+    tmpfilename = "%s.%s.tmp"%(filename, getQueueWorkerName())
+    fout = open(tmpfilename, 'wb')
+    fout.write(data)
+    fout.flush()
+    os.fsync(fout.fileno())
+    fout.close()
+    os.replace(tmpfilename, filename)
+
+def loadQueueFile(filename):
+    fin = open(filename, 'rb')
+    data = fin.read()
+    fin.close()
+    return data
+
+def submitQueueTasks(queueDir, funcName, argsList, Shared = None):
+    """
+    Put a list of tasks into a queue, replacing whatever tasks were there
+    before.  Tasks that are identical to ones that are already in the
+    queue keep their results, so a queue can be resubmitted after a
+    restart without redoing anything
+    :param queueDir: Path to the queue directory on a shared file system
+    :param funcName: Full name of the function to run on each argument
+        tuple, e.g. "BatchCollection.compareBatchBlock"
+    :param argsList: List of argument tuples, one per task
+    :param Shared: (Optional) A dictionary of large arguments that are the
+        same for many tasks, such as the list of all files.  These are
+        stored once for the whole queue, and every argument in a task
+        that is one of these objects refers to it instead of a copy
+    :returns: The number of tasks in the queue
+    """
+    if not Shared:
+        Shared = {}
+    for d in getQueueDirs(queueDir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    (tasksDir, locksDir, attemptsDir, doneDir, failedDir) = getQueueDirs(queueDir)
+    SharedData = pickle.dumps(Shared)
+    saveQueueFile("%s/shared.pkl"%queueDir, SharedData)
+    SharedHash = hashlib.sha1(SharedData).hexdigest()
+    argsList = list(argsList)
+    for i in range(len(argsList)):
+        stored = []
+        for a in argsList[i]:
+            name = None
+            for key, val in Shared.items():
+                if a is val:
+                    name = key
+            if name is None:
+                stored.append(('value', a))
+            else:
+                stored.append(('shared', name))
+        Task = {'func':funcName, 'args':stored, 'shared':SharedHash}
+        data = pickle.dumps(Task)
+        taskid = "%06i"%i
+        filename = "%s/%s.pkl"%(tasksDir, taskid)
+        if os.path.exists(filename) and loadQueueFile(filename) == data:
+            continue
+        saveQueueFile(filename, data)
+        clearQueueTask(queueDir, taskid)
+    #Remove tasks left over from a longer queue
+    for f in os.listdir(tasksDir):
+        if f[-4::] == ".pkl" and int(f[0:-4]) >= len(argsList):
+            os.remove("%s/%s"%(tasksDir, f))
+            clearQueueTask(queueDir, f[0:-4])
+    return len(argsList)
+
+def clearQueueTask(queueDir, taskid):
+    """
+    Forget the results and attempts of a task
+    """
+    (tasksDir, locksDir, attemptsDir, doneDir, failedDir) = getQueueDirs(queueDir)
+    for f in ["%s/%s.pkl"%(doneDir, taskid), "%s/%s"%(attemptsDir, taskid),
+              "%s/%s"%(failedDir, taskid), "%s/%s.log"%(failedDir, taskid)]:
+        if os.path.exists(f):
+            os.remove(f)
+
+def getQueueTaskIds(queueDir):
+    tasksDir = getQueueDirs(queueDir)[0]
+    return sorted([f[0:-4] for f in os.listdir(tasksDir) if f[-4::] == ".pkl"])
+
+def isQueueTaskFinished(queueDir, taskid):
+    """
+    Return True if a task is done or has permanently failed
+    """
+    (tasksDir, locksDir, attemptsDir, doneDir, failedDir) = getQueueDirs(queueDir)
+    return os.path.exists("%s/%s.pkl"%(doneDir, taskid)) or os.path.exists("%s/%s"%(failedDir, taskid))
+
+def getQueueLockOwner(lockfile):
+    """
+    Return the name of the worker that holds a lock file, or None if
+    there is no lock.  A lock that was just created may not have its
+    owner written into it yet, in which case this is an empty string
+    """
+    try:
+        fin = open(lockfile, 'rb')
+        owner = fin.read().decode('utf-8')
+        fin.close()
+    except FileNotFoundError:
+        return None
+    return owner
+
+def claimQueueTask(queueDir, taskid, leaseSeconds):
+    """
+    Try to take the lease on a task by exclusively creating its lock file.
+    If the lock file is there but hasn't been touched in leaseSeconds,
+    its worker is assumed to be dead and the lock is broken.  Breaking
+    a lock means renaming it away and checking that what was renamed is
+    still the same expired lock; if another worker broke it and took it
+    again in the meantime, the fresh lock is put back
+    :returns: True if this worker now holds the lease
+    """
+    lockfile = "%s/%s"%(getQueueDirs(queueDir)[1], taskid)
+    try:
+        fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        owner = getQueueLockOwner(lockfile)
+        try:
+            age = time.time() - os.path.getmtime(lockfile)
+        except FileNotFoundError:
+            return False
+        if owner is None or age < leaseSeconds:
+            return False
+        stalefile = "%s.%s.stale"%(lockfile, getQueueWorkerName())
+        try:
+            os.rename(lockfile, stalefile)
+        except FileNotFoundError:
+            return False
+        if getQueueLockOwner(stalefile) != owner or time.time() - os.path.getmtime(stalefile) < leaseSeconds:
+            #This is a live lock that someone else just took, so put it
+            #back, unless yet another worker has already made a new one
+            try:
+                os.link(stalefile, lockfile)
+            except FileExistsError:
+                pass
+            os.remove(stalefile)
+            return False
+        os.remove(stalefile)
+        print("Broke expired lease of %s on task %s"%(owner, taskid))
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+    os.write(fd, getQueueWorkerName().encode('utf-8'))
+    os.close(fd)
+    return True
+
+def releaseQueueTask(queueDir, taskid):
+    """
+    Give up the lease on a task, unless it has been broken and
+    taken over by another worker in the meantime
+    """
+    lockfile = "%s/%s"%(getQueueDirs(queueDir)[1], taskid)
+    if getQueueLockOwner(lockfile) == getQueueWorkerName():
+        os.remove(lockfile)
+
+def renewQueueLease(lockfile, interval, stopEvent):
+    """
+    Touch a lock file every interval seconds until stopEvent is set,
+    so that other workers know its task is still being worked on.
+    Stop if the lock no longer belongs to this worker, so that the
+    lease of a worker that took it over is never kept alive by this one
+    """
+    while not stopEvent.wait(interval):
+        if getQueueLockOwner(lockfile) != getQueueWorkerName():
+            print("Lost the lease on %s"%lockfile)
+            return
+        try:
+            os.utime(lockfile, None)
+        except FileNotFoundError:
+            return
+
+def recordQueueAttempt(queueDir, taskid):
+    """
+    Record that this worker is starting a task
+    :returns: The number of times the task has been started, including this one
+    """
+    filename = "%s/%s"%(getQueueDirs(queueDir)[2], taskid)
+    fout = open(filename, 'a')
+    fout.write("%s\t%g\n"%(getQueueWorkerName(), time.time()))
+    fout.close()
+    fin = open(filename, 'r')
+    attempts = len(fin.readlines())
+    fin.close()
+    return attempts
+
+def runQueueTask(queueDir, taskid, SharedCache):
+    """
+    Load a task, fill in its shared arguments, and run it
+    :param SharedCache: Dictionary holding the shared arguments of
+        this queue once they've been loaded by this worker
+    :returns: Whatever the task's function returns
+    """
+    Task = pickle.loads(loadQueueFile("%s/%s.pkl"%(getQueueDirs(queueDir)[0], taskid)))
+    if SharedCache.get('hash', None) != Task['shared']:
+        SharedCache['hash'] = Task['shared']
+        SharedCache['Shared'] = pickle.loads(loadQueueFile("%s/shared.pkl"%queueDir))
+    args = []
+    for (kind, val) in Task['args']:
+        if kind == 'shared':
+            args.append(SharedCache['Shared'][val])
+        else:
+            args.append(val)
+    (moduleName, funcName) = Task['func'].rsplit('.', 1)
+    func = getattr(importlib.import_module(moduleName), funcName)
+    return func(tuple(args))
+
+def runQueueWorker(queueDir, leaseSeconds = 600, maxAttempts = 3, pollInterval = 10):
+    """
+    Pull tasks from a queue and run them until every task in the
+    queue is either done or has failed maxAttempts times
+    :param queueDir: Path to the queue directory
+    :param leaseSeconds: Number of seconds without a heartbeat after
+        which a task's lease expires and another worker may take it over
+    :param maxAttempts: Number of times a task is started before
+        it is marked as failed
+    :param pollInterval: Seconds to wait before checking again when all
+        of the remaining tasks are leased by other workers
+    :returns: The number of tasks this worker finished
+    """
+    (tasksDir, locksDir, attemptsDir, doneDir, failedDir) = getQueueDirs(queueDir)
+    SharedCache = {}
+    count = 0
+    while True:
+        pending = [t for t in getQueueTaskIds(queueDir) if not isQueueTaskFinished(queueDir, t)]
+        if len(pending) == 0:
+            break
+        ran = False
+        for taskid in pending:
+            if isQueueTaskFinished(queueDir, taskid) or not claimQueueTask(queueDir, taskid, leaseSeconds):
+                continue
+            #Someone else may have finished it just before we claimed it
+            if isQueueTaskFinished(queueDir, taskid):
+                releaseQueueTask(queueDir, taskid)
+                continue
+            ran = True
+            attempts = recordQueueAttempt(queueDir, taskid)
+            if attempts > maxAttempts:
+                print("Task %s failed after %i attempts"%(taskid, maxAttempts))
+                saveQueueFile("%s/%s"%(failedDir, taskid), getQueueWorkerName().encode('utf-8'))
+                releaseQueueTask(queueDir, taskid)
+                continue
+            stopEvent = threading.Event()
+            heartbeat = threading.Thread(target=renewQueueLease, args=("%s/%s"%(locksDir, taskid), leaseSeconds/4.0, stopEvent))
+            heartbeat.daemon = True
+            heartbeat.start()
+            tic = time.time()
+            try:
+                result = runQueueTask(queueDir, taskid, SharedCache)
+                saveQueueFile("%s/%s.pkl"%(doneDir, taskid), pickle.dumps(result))
+                count += 1
+                print("Worker %s finished task %s in %g seconds"%(getQueueWorkerName(), taskid, time.time()-tic))
+            except Exception:
+                fout = open("%s/%s.log"%(failedDir, taskid), 'a')
+                fout.write("Attempt %i by %s\n%s\n"%(attempts, getQueueWorkerName(), traceback.format_exc()))
+                fout.close()
+                print("Task %s raised an exception on attempt %i; see %s/%s.log"%(taskid, attempts, failedDir, taskid))
+            finally:
+                stopEvent.set()
+                heartbeat.join()
+                releaseQueueTask(queueDir, taskid)
+            stdout.flush()
+        if not ran:
+            time.sleep(pollInterval)
+    return count
+
+def startQueueWorkers(queueDir, NWorkers, leaseSeconds = 600, maxAttempts = 3):
+    """
+    Start worker processes for a queue on this machine
+    :returns: A list of the worker processes
+    """
+    workers = []
+    for i in range(NWorkers):
+        p = Process(target=runQueueWorker, args=(queueDir, leaseSeconds, maxAttempts))
+        p.start()
+        workers.append(p)
+    return workers
+
+def waitForQueue(queueDir, pollInterval = 10):
+    """
+    A barrier that waits until every task in a queue is done
+    :param queueDir: Path to the queue directory
+    :param pollInterval: Seconds between checks
+    :raises Exception: If any task has permanently failed
+    """
+    (tasksDir, locksDir, attemptsDir, doneDir, failedDir) = getQueueDirs(queueDir)
+    while True:
+        taskids = getQueueTaskIds(queueDir)
+        failed = [t for t in taskids if os.path.exists("%s/%s"%(failedDir, t))]
+        if len(failed) > 0:
+            raise Exception("%i tasks failed in queue %s, e.g. %s"%(len(failed), queueDir, "%s/%s.log"%(failedDir, failed[0])))
+        done = [t for t in taskids if os.path.exists("%s/%s.pkl"%(doneDir, t))]
+        if len(done) == len(taskids):
+            return
+        time.sleep(pollInterval)
+
+def getQueueResults(queueDir):
+    """
+    Load the results of every task in a queue, one at a time
+    :returns: A generator of (task index, result), in task order
+    """
+    doneDir = getQueueDirs(queueDir)[3]
+    for taskid in getQueueTaskIds(queueDir):
+        yield (int(taskid), pickle.loads(loadQueueFile("%s/%s.pkl"%(doneDir, taskid))))
+
+if __name__ == '__main__':
+    if len(argv) < 2:
+        print("Usage: python JobQueue.py <queueDir> [<leaseSeconds>] [<maxAttempts>]")
+        exit(0)
+    leaseSeconds = 600
+    maxAttempts = 3
+    if len(argv) > 2:
+        leaseSeconds = float(argv[2])
+    if len(argv) > 3:
+        maxAttempts = int(argv[3])
+    runQueueWorker(argv[1], leaseSeconds, maxAttempts)
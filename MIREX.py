@@ -4,6 +4,7 @@ Purpose: An entry point for the MIREX 2017 cover song ID task
 """
 import numpy as np
 import scipy.io as sio
+import os
 from multiprocessing import Pool as PPool
 from BatchCollection import *
 from sys import exit, argv
@@ -72,64 +73,197 @@ if __name__ == '__main__':
                      'ChromasPerBlock':ChromasPerBlock,
                      'NMFCC':NMFCC,
                      'lifterexp':lifterexp}
+    #Optionally store the SSM affinity matrices as sparse nearest neighbor graphs
+    SparseWNeighbors = config.getint('HYPERPARAMETERS', 'sparseWNeighbors', fallback=0)
+    if SparseWNeighbors > 0:
+        FeatureParams['SparseWNeighbors'] = SparseWNeighbors
 
     CSMTypes = {'MFCCs':'Euclidean',
                 'SSMs':'Euclidean',
                 'Chromas':'CosineOTI'}
 
+    #Options for comparing blocks that change the scores
+    BlockParams = {}
+    TempoPairs = config.getint('HYPERPARAMETERS', 'tempoPairs', fallback=0)
+    if TempoPairs > 0:
+        BlockParams['TempoPairs'] = TempoPairs
+        BlockParams['TempoProxy'] = config.get('HYPERPARAMETERS', 'tempoProxy', fallback='CSM')
+    FusionEngine = config.get('HYPERPARAMETERS', 'fusionEngine', fallback='Dense')
+    if FusionEngine == 'Sparse':
+        BlockParams['FusionEngine'] = FusionEngine
+        #The sparse engine needs a limit on the entries in each row to be fast
+        FusionKeepK = config.getint('HYPERPARAMETERS', 'fusionKeepK', fallback=0)
+        if FusionKeepK <= 0:
+            FusionKeepK = BATCH_FUSION_KEEP_K
+        BlockParams['FusionKeepK'] = FusionKeepK
+        BlockParams['FusionMassTol'] = config.getfloat('HYPERPARAMETERS', 'fusionMassTol', fallback=1e-4)
+    CSMDtype = config.get('HYPERPARAMETERS', 'csmDtype', fallback='float64')
+    if not CSMDtype == 'float64':
+        BlockParams['CSMDtype'] = CSMDtype
+
+    #If the collection has grown since the last run, keep the songs
+    #that were already compared at the front, and only compare the
+    #new songs to everything else.  This is only safe if nothing
+    #that changes the scores is different from the last run
+    outFiles = allFiles
+    query2Out = query2All
+    ScoreParamsHash = getFeatureParamsHash({'hopSize':hopSize, 'Kappa':Kappa, 'CSMTypes':CSMTypes,
+                        'FeatureParams':FeatureParams, 'TempoLevels':TempoLevels, 'BlockParams':BlockParams})
+    DsOld = None
+    incremental = config.getboolean('PARAMETERS', 'incremental', fallback=False)
+    if incremental and os.path.exists("%s/D.mat"%scratchDir) and os.path.exists("%s/DFiles.txt"%scratchDir):
+        oldHash = None
+        if os.path.exists("%s/DParams.txt"%scratchDir):
+            fin = open("%s/DParams.txt"%scratchDir, 'r')
+            oldHash = fin.read().strip()
+            fin.close()
+        if oldHash == ScoreParamsHash:
+            fin = open("%s/DFiles.txt"%scratchDir, 'r')
+            oldFiles = [f.strip() for f in fin.readlines()]
+            fin.close()
+            (allFiles, oldIdx) = getIncrementalBatchOrder(oldFiles, allFiles)
+            allIdx = {allFiles[i]:i for i in range(len(allFiles))}
+            query2All = {i:allIdx[queryFiles[i]] for i in range(len(queryFiles))}
+            DsOld = loadBatchScores(scratchDir)
+            logger.info("--> Incremental run: %i songs already compared, %i new"%(len(oldIdx), len(allFiles)-len(oldIdx)))
+        else:
+            logger.warning("--> Parameters changed since the last run, so comparing all songs again")
+
     #Setup parallel pool
     NThreads = int(config.get('PARAMETERS', 'numberOfThreads'))
     logger.info("--> Process will run with {} Threads".format(NThreads))
-    parpool = PPool(NThreads)
+    #Workers are restarted after this many tasks to cap their memory growth
+    maxTasksPerChild = config.getint('PARAMETERS', 'maxTasksPerChild', fallback=10)
+    parpool = PPool(NThreads, maxtasksperchild = maxTasksPerChild)
+
+    #Look up where the features of each song are cached, based on
+    #the audio contents and all of the feature parameters
+    logger.info("--> Resolving the feature cache")
+    CacheParams = {'hopSize':hopSize, 'Kappa':Kappa, 'CSMTypes':CSMTypes, 'FeatureParams':FeatureParams, 'TempoLevels':TempoLevels}
+    FeatureFiles = resolveFeatureCache(scratchDir, allFiles, CacheParams, parpool)
 
     #Precompute beat intervals, MFCC, and HPCP Features for each song
     logger.info("--> Precompute the features for each song")
     NF = len(allFiles)
-    args = zip(allFiles, [scratchDir]*NF, [hopSize]*NF, [Kappa]*NF, [CSMTypes]*NF, [FeatureParams]*NF, [TempoLevels]*NF, [{}]*NF)
+    args = zip(allFiles, [scratchDir]*NF, [hopSize]*NF, [Kappa]*NF, [CSMTypes]*NF, [FeatureParams]*NF, [TempoLevels]*NF, [{}]*NF, FeatureFiles)
 
     """
     for i in range(NF):
-        precomputeBatchFeatures((allFiles[i], scratchDir, hopSize, Kappa, CSMTypes, FeatureParams, TempoLevels, {}))
+        precomputeBatchFeatures((allFiles[i], scratchDir, hopSize, Kappa, CSMTypes, FeatureParams, TempoLevels, {}, FeatureFiles[i]))
     """
-    parpool.map(precomputeBatchFeatures, args)
+    #Optionally share the work through a job queue in the scratch
+    #directory, which workers on other machines can pull from too
+    useJobQueue = config.getboolean('PARAMETERS', 'jobQueue', fallback=False)
+    leaseSeconds = config.getfloat('PARAMETERS', 'leaseSeconds', fallback=600)
+    maxAttempts = config.getint('PARAMETERS', 'maxAttempts', fallback=3)
+    if useJobQueue:
+        list(runBatchQueue("%s/queue/features"%scratchDir, "BatchCollection.precomputeBatchFeatures", args, {}, NThreads, leaseSeconds, maxAttempts))
+    else:
+        precomputeBatchFeaturesDynamic(parpool, args)
+    #Pack all features into one memory mapped file that the block
+    #workers can share
+    packFeatureStore(scratchDir, FeatureFiles)
 
     #Process blocks of similarity at a time
     logger.info("--> Perform Similarity Analysis")
     N = len(allFiles)
-    NPerBlock = int(config.get('PARAMETERS', 'numberPerBlock'))
-    ranges = getBatchBlockRanges(N, NPerBlock)
-    args = zip(ranges, [Kappa]*len(ranges), [CSMTypes]*len(ranges), [allFiles]*len(ranges), [scratchDir]*len(ranges))
-    res = parpool.map(compareBatchBlock, args)
-    Ds = assembleBatchBlocks(list(CSMTypes) + ['SNF'], res, ranges, N)
+    #Only do the upper triangular blocks, and start the most
+    #expensive ones first so that all threads finish together
+    Beats = getBatchSongBeats(allFiles, scratchDir, FeatureFiles)
+    NPerBlock = config.get('PARAMETERS', 'numberPerBlock')
+    if NPerBlock == 'auto':
+        #Size the blocks and the number of workers to fit in memory
+        MemoryBudget = config.getfloat('PARAMETERS', 'memoryBudgetGB')*1e9
+        SongBytes = getBatchSongBytes(allFiles, scratchDir, FeatureFiles, CSMTypes)
+        (NPerBlock, NWorkers) = getBatchAutoBlockSize(Beats, SongBytes, len(CSMTypes), MemoryBudget, NThreads)
+        if NWorkers < NThreads:
+            parpool.close()
+            NThreads = NWorkers
+            parpool = PPool(NThreads, maxtasksperchild = maxTasksPerChild)
+    else:
+        NPerBlock = int(NPerBlock)
+    if DsOld is None:
+        ranges = getBatchBlockRangesTriangular(N, NPerBlock, Beats)
+    else:
+        ranges = getBatchBlockRangesIncremental(len(oldIdx), N, NPerBlock, Beats)
+    ranges = scheduleBatchBlocks(ranges, Beats)
+    BlockParams['FeatureFiles'] = FeatureFiles
+    args = zip(ranges, [Kappa]*len(ranges), [CSMTypes]*len(ranges), [allFiles]*len(ranges), [scratchDir]*len(ranges), [BlockParams]*len(ranges))
+    #Write blocks into score matrices on disk as they finish
+    FeatureTypes = list(CSMTypes) + ['SNF']
+    Ds = openBatchScoreMatrices(scratchDir, FeatureTypes, N)
+    if DsOld is not None:
+        Ds = growBatchScores(Ds, DsOld, oldIdx, FeatureTypes, N)
+        removeBatchScores(DsOld)
+        DsOld = None
+    if useJobQueue:
+        Shared = {'allFiles':allFiles, 'BlockParams':BlockParams}
+        for (i, Block) in runBatchQueue("%s/queue/blocks"%scratchDir, "BatchCollection.compareBatchBlock", args, Shared, NThreads, leaseSeconds, maxAttempts):
+            addBatchBlock(Ds, ranges[i], Block)
+        for F in Ds:
+            Ds[F].flush()
+    else:
+        Ds = streamBatchBlocks(parpool, args, Ds)
 
     #Perform late fusion
     logger.info("--> Performing Late Fusion")
     numberOfNearestNeighbor = int(config.get('HYPERPARAMETERS', 'numberOfNearestNeighbor'))
     numberOfIter = int(config.get('HYPERPARAMETERS', 'numberOfIter'))
-    Scores = [1.0/(1.0+Ds[F]) for F in Ds.keys()]
-    Ds['Late'] = doSimilarityFusion(Scores, numberOfNearestNeighbor, numberOfIter, 1)
-    D = np.exp(-Ds['Late']) #Turn similarity score into a distance
+    #With a tolerance, numberOfIter is only the most iterations to do
+    fusionTol = config.getfloat('HYPERPARAMETERS', 'fusionTol', fallback=0)
+    lateFusion = config.get('HYPERPARAMETERS', 'lateFusion', fallback='Dense')
+    if lateFusion == 'Sparse':
+        #Stream the score matrices from disk into sparse nearest
+        #neighbor graphs, and keep the result sparse, so that nothing
+        #NxN has to fit in memory
+        lateFusionKeepK = config.getint('HYPERPARAMETERS', 'lateFusionKeepK', fallback=0)
+        lateFusionOutK = config.getint('HYPERPARAMETERS', 'lateFusionOutK', fallback=0)
+        Scores = [Ds[F] for F in Ds.keys()]
+        (Ds['Late'], Info) = doSimilarityFusionSparseKNN(Scores, numberOfNearestNeighbor, numberOfIter, 1,
+                    KeepK = lateFusionKeepK if lateFusionKeepK > 0 else None,
+                    OutK = lateFusionOutK if lateFusionOutK > 0 else None,
+                    Transform = lambda X: 1.0/(1.0+X), tol=fusionTol, retInfo=True)
+    else:
+        Scores = [1.0/(1.0+Ds[F]) for F in Ds.keys()]
+        (Ds['Late'], Info) = doSimilarityFusion(Scores, numberOfNearestNeighbor, numberOfIter, 1, tol=fusionTol, retInfo=True)
+    logger.info("--> Late fusion took {} iterations, final relative change {:.3g}".format(Info['NIters'], Info['Residual']))
 
     #Save full distance matrix in case there's a problem
     #with the text output
     logger.info("--> Save the Matrix form of results")
-    sio.savemat("%s/D.mat"%scratchDir, Ds)
+    if lateFusion == 'Sparse':
+        saveBatchScoresSparse(scratchDir, Ds, FeatureTypes)
+    else:
+        sio.savemat("%s/D.mat"%scratchDir, Ds)
+    fout = open("%s/DFiles.txt"%scratchDir, "w")
+    for f in allFiles:
+        fout.write("%s\n"%f)
+    fout.close()
+    fout = open("%s/DParams.txt"%scratchDir, "w")
+    fout.write("%s\n"%ScoreParamsHash)
+    fout.close()
+
+    #The results are written in the order of the collection and query
+    #lists, even if an incremental run compared the songs in another order
+    allIdx = {allFiles[i]:i for i in range(len(allFiles))}
+    outIdx = np.array([allIdx[f] for f in outFiles], dtype=np.int64)
 
     #Save the results to a text file
     logger.info("--> Generating Final Results")
     fout = open(filenameOut, "w")
     fout.write("Early+Late SNF Chris Tralie 2017\n")
-    for i in range(len(allFiles)):
-        f = allFiles[i]
+    for i in range(len(outFiles)):
+        f = outFiles[i]
         fout.write("%i\t%s\n"%(i+1, f))
     fout.write("Q/R")
-    for i in range(len(allFiles)):
+    for i in range(len(outFiles)):
         fout.write("\t%i"%(i+1))
     for i in range(len(queryFiles)):
         idx = query2All[i]
-        fout.write("\n%i"%(idx+1))
-        for j in range(len(allFiles)):
-            fout.write("\t%g"%(D[idx, j]))
+        D = getLateFusionDistances(Ds['Late'], idx)[outIdx]
+        fout.write("\n%i"%(query2Out[i]+1))
+        for j in range(len(outFiles)):
+            fout.write("\t%g"%(D[j]))
     fout.close()
 
     #Save the top results in CSV
@@ -139,20 +273,25 @@ if __name__ == '__main__':
     for i in range(len(queryFiles)):
         queryFileName = queryFiles[i]
         idx = query2All[i]
+        D = getLateFusionDistances(Ds['Late'], idx)[outIdx]
         disSimilarityValues = []
-        for j in range(len(allFiles)-len(queryFiles)-1):
-            disSimilarityValues.append(D[idx, j])
+        for j in range(len(outFiles)-len(queryFiles)-1):
+            disSimilarityValues.append(D[j])
         std = statistics.stdev(disSimilarityValues)
         mean = statistics.mean(disSimilarityValues)
 
         best_match_std = (mean - min(disSimilarityValues)) / std
         if best_match_std >= float(config.get('PARAMETERS', 'matchingThreshold')):
             idx_min = np.argmin(disSimilarityValues)
-            matchedFileName = allFiles[np.int(idx_min)]
+            matchedFileName = outFiles[int(idx_min)]
             topresults.loc[i, 'QueryFileName'] = queryFileName
             topresults.loc[i, 'MatchedFileName'] = matchedFileName
         else:
             topresults.loc[i, 'QueryFileName'] = queryFileName
             topresults.loc[i, 'MatchedFileName'] = 'Low Confidence {}'.format(best_match_std)
 
-    topresults.to_csv('TopResults.csv',header=True, index=False)
\ No newline at end of file
+    topresults.to_csv('TopResults.csv',header=True, index=False)
+
+    #Mark the features as used now, so garbage collection by age
+    #doesn't count the time this run took against them
+    touchFeatureCache(scratchDir, FeatureFiles)
@@ -16,15 +16,19 @@ static char swalignimp_docstring[] =
     "Perform Smith Waterman on a binary matrix";
 static char swalignimpconstrained_docstring[] =
     "Perform Smith Waterman with diagonal constraints on a binary matrix";
+static char swalignimpconstrainedpacked_docstring[] =
+    "Perform Smith Waterman with diagonal constraints on a binary matrix whose rows were packed with np.packbits, given its number of columns";
 
 /* Available functions */
 static PyObject *SequenceAlignment_swalignimp(PyObject *self, PyObject *args);
 static PyObject *SequenceAlignment_swalignimpconstrained(PyObject *self, PyObject *args);
+static PyObject *SequenceAlignment_swalignimpconstrainedpacked(PyObject *self, PyObject *args);
 
 /* Module specification */
 static PyMethodDef module_methods[] = {
     {"swalignimp", SequenceAlignment_swalignimp, METH_VARARGS, swalignimp_docstring},
     {"swalignimpconstrained", SequenceAlignment_swalignimpconstrained, METH_VARARGS, swalignimpconstrained_docstring},
+    {"swalignimpconstrainedpacked", SequenceAlignment_swalignimpconstrainedpacked, METH_VARARGS, swalignimpconstrainedpacked_docstring},
     {NULL, NULL, 0, NULL}
 };
 
@@ -128,3 +132,43 @@ static PyObject *SequenceAlignment_swalignimpconstrained(PyObject *self, PyObjec
     PyObject *ret = Py_BuildValue("d", score);
     return ret;
 }
+
+static PyObject *SequenceAlignment_swalignimpconstrainedpacked(PyObject *self, PyObject *args)
+{
+    PyObject *S_obj;
+    int M;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(args, "Oi", &S_obj, &M))
+        return NULL;
+
+    /* Interpret the input objects as numpy arrays. */
+    PyObject *S_array = PyArray_FROM_OTF(S_obj, NPY_UINT8, NPY_IN_ARRAY);
+    
+    /* If that didn't work, throw an exception. */
+    if (S_array == NULL) {
+        Py_XDECREF(S_array);
+        return NULL;
+    }
+
+    int N = (int)PyArray_DIM(S_array, 0);
+    int RowBytes = (int)PyArray_DIM(S_array, 1);
+    if (RowBytes*8 < M) {
+        Py_DECREF(S_array);
+        PyErr_SetString(PyExc_ValueError, "Packed rows are too short for the number of columns");
+        return NULL;
+    }
+
+    /* Get pointers to the data as C-types. */
+    unsigned char *S = (unsigned char*)PyArray_DATA(S_array);
+
+    /* Perform Smith Waterman */
+    double score = swalignimpconstrainedpacked(S, N, M, RowBytes);
+
+    /* Clean up. */
+    Py_DECREF(S_array);
+
+    /* Build the output tuple */
+    PyObject *ret = Py_BuildValue("d", score);
+    return ret;
+}
@@ -119,3 +119,64 @@ double swalignimpconstrained(double* S, int N, int M) {
     free(D);
     return maxD;
 }
+
+/*Unpack row i of a matrix whose rows were packed 8 columns per byte,
+*most significant bit first (as with np.packbits), into one byte per column*/
+void unpackrow(unsigned char* S, int RowBytes, int i, int M, unsigned char* row) {
+    int j;
+    for (j = 0; j < M; j++) {
+        row[j] = (S[i*RowBytes+(j>>3)] >> (7-(j&7))) & 1;
+    }
+}
+
+/*Inputs: S (a binary N x M cross-similarity matrix, with each row
+*packed into RowBytes bytes)*/
+
+/*Outputs: Distance (scalar), the same as swalignimpconstrained on the
+*unpacked matrix.  Only the last 3 rows of the dynamic programming
+*matrix and the last 3 unpacked rows of S are kept at any time*/
+double swalignimpconstrainedpacked(unsigned char* S, int N, int M, int RowBytes) {
+    double *D, *D0, *D1, *D2, *Temp;
+    unsigned char *B, *B1, *B2, *B3;
+    int i, j;
+    double maxD, d1, d2, d3, MS, s;
+    
+    N++; M++;
+    if (N < 4 || M < 4) {
+        return 0.0;
+    }
+    /*Rows i, i-1 and i-2 of the dynamic programming matrix, with
+    the first 3 rows and columns initialized to zero*/
+    D = (double*)calloc(3*M, sizeof(double));
+    D0 = D; D1 = D + M; D2 = D + 2*M;
+    /*Rows i-1, i-2 and i-3 of S (and a spare)*/
+    B = (unsigned char*)malloc(4*(M-1));
+    unpackrow(S, RowBytes, 0, M-1, B);
+    unpackrow(S, RowBytes, 1, M-1, B + (M-1));
+
+    maxD = 0.0;
+    for (i = 3; i < N; i++) {
+        B1 = B + ((i-1)%4)*(M-1);
+        B2 = B + ((i-2)%4)*(M-1);
+        B3 = B + ((i-3)%4)*(M-1);
+        unpackrow(S, RowBytes, i-1, M-1, B1);
+        for (j = 3; j < M; j++) {
+            s = B1[j-1];
+            MS = Match(s);
+            /*H_(i-1, j-1) + S_(i-1, j-1) + delta(S_(i-2,j-2), S_(i-1, j-1))*/
+            d1 = D1[j-1] + MS + Delta(B2[j-2], s);
+            /*H_(i-2, j-1) + S_(i-1, j-1) + delta(S_(i-3, j-2), S_(i-1, j-1))*/
+            d2 = D2[j-1] + MS + Delta(B3[j-2], s);
+            /*H_(i-1, j-2) + S_(i-1, j-1) + delta(S_(i-2, j-3), S_(i-1, j-1))*/
+            d3 = D1[j-2] + MS + Delta(B2[j-3], s);
+            D0[j] = quadMax(d1, d2, d3, 0.0);
+            if (D0[j] > maxD) {
+                maxD = D0[j];
+            }
+        }
+        Temp = D2; D2 = D1; D1 = D0; D0 = Temp;
+    }
+    free(D);
+    free(B);
+    return maxD;
+}
@@ -1,2 +1,3 @@
 double swalignimp(double* S, int N, int M);
 double swalignimpconstrained(double* S, int N, int M) ;
+double swalignimpconstrainedpacked(unsigned char* S, int N, int M, int RowBytes);
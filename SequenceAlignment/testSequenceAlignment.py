@@ -19,6 +19,12 @@ def compareTimes():
     end = time.time()
     print("Time elapsed C: %g seconds, ans = %g"%(end-start, ans))
 
+    Packed = np.packbits(D > 0, axis=1)
+    start = time.time()
+    ans = SAC.swalignimpconstrainedpacked(Packed, D.shape[1])
+    end = time.time()
+    print("Time elapsed C packed: %g seconds, ans = %g"%(end-start, ans))
+
     start = time.time()
     ans = SA.swalignimpconstrained(D)[0]
     end = time.time()
@@ -7,50 +7,196 @@ Purpose: To implement similarity network fusion approach described in
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import sparse
+import scipy.sparse.linalg
 import scipy.ndimage.interpolation as interp
 import scipy.io as sio
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from EvalStatistics import *
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
-def getW(D, K, Mu = 0.5):
+def getNeighborIndex(D, KRow, KCol, largest = False):
     """
-    Return affinity matrix
+    Find the nearest neighbors of every row and every column of a
+    matrix at once, sorted from nearest to farthest, so that all of
+    the functions that need some number of them (getW, getWCSM, getS,
+    CSMToBinary, CSMToBinaryMutual) can share one set of partitions
+    :param D: MxN matrix
+    :param KRow: Number of neighbors to find in each row
+    :param KCol: Number of neighbors to find in each column
+    :param largest: If True, neighbors are the largest entries
+        (as in an affinity matrix) instead of the smallest
+    :returns NIndex: {'RowJ': (M x KRow) column indices of the
+        neighbors of each row, 'RowV': (M x KRow) their values,
+        'ColJ': (N x KCol) row indices of the neighbors of each
+        column, 'ColV': (N x KCol) their values, 'largest'}
+    """
+    X = D
+    if largest:
+        X = -D
+    NIndex = {'largest':largest}
+    for (name, A, K) in [('Row', X, KRow), ('Col', X.T, KCol)]:
+        K = min(K, A.shape[1])
+        rows = np.arange(A.shape[0])[:, None]
+        J = np.zeros((A.shape[0], 0), dtype=np.int64)
+        if K > 0:
+            J = np.argpartition(A, K-1, 1)[:, 0:K]
+        V = A[rows, J]
+        order = np.argsort(V, 1, kind='stable')
+        (J, V) = (J[rows, order], V[rows, order])
+        if largest:
+            V = -V
+        NIndex['%sJ'%name] = J
+        NIndex['%sV'%name] = V
+    return NIndex
+
+def transposeNeighborIndex(NIndex):
+    """
+    Return the neighbor index of the transpose of a matrix
+    from the neighbor index of the matrix
+    """
+    return {'largest':NIndex['largest'], 'RowJ':NIndex['ColJ'], 'RowV':NIndex['ColV'],
+            'ColJ':NIndex['RowJ'], 'ColV':NIndex['RowV']}
+
+def getAffinityChunk(D, MeanDist1, MeanDist2, Mu, out, Eps):
+    """
+    Apply the SNF kernel W(i, j) = exp(-Dij^2/(2*(mu*epsij)^2)), with
+    epsij = (MeanDist1i + MeanDist2j + Dij)/3, to a block of rows of a
+    distance matrix, one operation at a time in place, so that no
+    temporaries bigger than the block are ever made
+    :param D: (RxN) Block of distances.  This is overwritten
+    :param MeanDist1: (R) Mean neighbor distance of each row in the block
+    :param MeanDist2: (N) Mean neighbor distance of each column
+    :param Mu: Nearest neighbor hyperparameter
+    :param out: (RxN) Array (or view) into which to write the affinities
+    :param Eps: (RxN) Scratch array of the same type as D
+    """
+    np.add(MeanDist1[:, None], MeanDist2[None, :], out=Eps)
+    Eps += D
+    Eps /= 3
+    Eps *= Mu
+    np.square(Eps, out=Eps)
+    Eps *= 2
+    np.square(D, out=D)
+    np.negative(D, out=D)
+    D /= Eps
+    np.exp(D, out=out)
+
+def getW(D, K, Mu = 0.5, NIndex = None, out = None, RowsPerChunk = 1000, dtype = np.float64):
+    """
+    Return affinity matrix.  This is computed a block of rows at a
+    time, so the only scratch memory is two blocks of RowsPerChunk rows
     :param D: Self-similarity matrix
     :param K: Number of nearest neighbors
     :param Mu: Nearest neighbor hyperparameter (default 0.5)
+    :param NIndex: (Optional) getNeighborIndex of 0.5*(D + D^T) with
+        its diagonal set to 0, with at least K+1 neighbors per row
+    :param out: (Optional) NxN array (or view, such as a quadrant of
+        a bigger matrix) into which to write the affinities
+    :param RowsPerChunk: Number of rows to do at a time
+    :param dtype: Type of the result if out isn't given.  The
+        computation is done in the type of the result
+    :returns W: The affinity matrix (out, if it was given)
     """
     #W(i, j) = exp(-Dij^2/(mu*epsij))
-    DSym = 0.5*(D + D.T)
-    np.fill_diagonal(DSym, 0)
+    N = D.shape[0]
+    if out is None:
+        out = np.empty((N, N), dtype=dtype)
+    RowsPerChunk = max(1, min(RowsPerChunk, N))
+    DSym = np.empty((RowsPerChunk, N), dtype=out.dtype)
+    Eps = np.empty((RowsPerChunk, N), dtype=out.dtype)
 
-    Neighbs = np.partition(DSym, K+1, 1)[:, 0:K+1]
-    MeanDist = np.mean(Neighbs, 1)*float(K+1)/float(K) #Need this scaling
+    def getDSymRows(i1, i2):
+        #Rows i1:i2 of 0.5*(D + D^T) with the diagonal set to 0
+        C = DSym[0:i2-i1]
+        np.add(D[i1:i2, :], D[:, i1:i2].T, out=C)
+        C *= 0.5
+        C[np.arange(i2-i1), np.arange(i1, i2)] = 0
+        return C
+
+    if NIndex is None or NIndex['RowV'].shape[1] < K+1:
+        MeanDist = np.zeros(N)
+        for i1 in range(0, N, RowsPerChunk):
+            i2 = min(i1+RowsPerChunk, N)
+            Neighbs = np.partition(getDSymRows(i1, i2), K+1, 1)[:, 0:K+1]
+            MeanDist[i1:i2] = np.mean(Neighbs, 1)
+    else:
+        MeanDist = np.mean(NIndex['RowV'][:, 0:K+1], 1)
+    MeanDist = MeanDist*float(K+1)/float(K) #Need this scaling
     #to exclude diagonal element in mean
     #Equation 1 in SNF paper [2] for estimating local neighborhood radii
     #by looking at k nearest neighbors, not including point itself
-    Eps = MeanDist[:, None] + MeanDist[None, :] + DSym
-    Eps = Eps/3
-    W = np.exp(-DSym**2/(2*(Mu*Eps)**2))
-    return W
+    for i1 in range(0, N, RowsPerChunk):
+        i2 = min(i1+RowsPerChunk, N)
+        getAffinityChunk(getDSymRows(i1, i2), MeanDist[i1:i2], MeanDist, Mu, out[i1:i2, :], Eps[0:i2-i1])
+    return out
 
-def getWCSM(CSMAB, k1, k2, Mu = 0.5):
+def sparsifyW(W, K, dtype = np.float32):
     """
-    Get a cross similarity matrix from a cross dissimilarity matrix
+    Keep only the K largest affinities in each row of a symmetric
+    affinity matrix, and symmetrize the result by taking the union
+    of the neighbor sets.  As long as K is at least the number of
+    neighbors used in getS, the S matrix in similarity fusion is
+    unchanged; only the row normalization in getP loses the tail
+    :param W: (NxN) Symmetric affinity matrix
+    :param K: Number of neighbors to keep in each row
+    :param dtype: Type in which to store the values
+    :returns: (NxN) Sparse CSR matrix
+    """
+    N = W.shape[0]
+    K = min(K, N)
+    J = np.argpartition(-W, K-1, 1)[:, 0:K]
+    I = np.tile(np.arange(N)[:, None], (1, K))
+    WS = sparse.coo_matrix((W[I, J].flatten(), (I.flatten(), J.flatten())), shape=(N, N)).tocsr()
+    WS = WS.maximum(WS.T)
+    return WS.astype(dtype).tocsr()
+
+def getWCSM(CSMAB, k1, k2, Mu = 0.5, NIndex = None, out = None, RowsPerChunk = 1000, dtype = np.float64):
+    """
+    Get a cross similarity matrix from a cross dissimilarity matrix.
+    Like getW, this is done a block of rows at a time
     :param CSMAB: Cross-similarity matrix
     :param k1: Number of neighbors across rows
     :param k2: Number of neighbors down columns
     :param Mu: Nearest neighbor hyperparameter
+    :param NIndex: (Optional) getNeighborIndex of CSMAB, with at least
+        k2 neighbors per row and k1 per column
+    :param out, RowsPerChunk, dtype: Output, block size and type
+        of the result (see getW)
     :returns W: Exponential weighted similarity matrix
     """
-    Neighbs1 = np.partition(CSMAB, k2, 1)[:, 0:k2]
-    MeanDist1 = np.mean(Neighbs1, 1)
+    (M, N) = CSMAB.shape
+    if out is None:
+        out = np.empty((M, N), dtype=dtype)
+    RowsPerChunk = max(1, min(RowsPerChunk, M))
+    if NIndex is None or NIndex['RowV'].shape[1] < k2:
+        MeanDist1 = np.zeros(M)
+        for i1 in range(0, M, RowsPerChunk):
+            i2 = min(i1+RowsPerChunk, M)
+            MeanDist1[i1:i2] = np.mean(np.partition(CSMAB[i1:i2, :], k2, 1)[:, 0:k2], 1)
+    else:
+        MeanDist1 = np.mean(NIndex['RowV'][:, 0:k2], 1)
 
-    Neighbs2 = np.partition(CSMAB, k1, 0)[0:k1, :]
-    MeanDist2 = np.mean(Neighbs2, 0)
-    Eps = MeanDist1[:, None] + MeanDist2[None, :] + CSMAB
-    Eps /= 3
-    return np.exp(-CSMAB**2/(2*(Mu*Eps)**2))
+    if NIndex is None or NIndex['ColV'].shape[1] < k1:
+        MeanDist2 = np.zeros(N)
+        for j1 in range(0, N, RowsPerChunk):
+            j2 = min(j1+RowsPerChunk, N)
+            MeanDist2[j1:j2] = np.mean(np.partition(CSMAB[:, j1:j2], k1, 0)[0:k1, :], 0)
+    else:
+        MeanDist2 = np.mean(NIndex['ColV'][:, 0:k1].T, 0)
+    Chunk = np.empty((RowsPerChunk, N), dtype=out.dtype)
+    Eps = np.empty((RowsPerChunk, N), dtype=out.dtype)
+    for i1 in range(0, M, RowsPerChunk):
+        i2 = min(i1+RowsPerChunk, M)
+        C = Chunk[0:i2-i1]
+        C[:] = CSMAB[i1:i2, :]
+        getAffinityChunk(C, MeanDist1[i1:i2], MeanDist2, Mu, out[i1:i2, :], Eps[0:i2-i1])
+    return out
 
 def setupWCSMSSM(WSSMA, WSSMB, WCSMAB):
     """
@@ -60,19 +206,25 @@ def setupWCSMSSM(WSSMA, WSSMB, WCSMAB):
     :param WSSMA: W matrix for upper left SSM part
     :param WSSMB: W matrix for lower SSM part
     :param WCSMAB: Cross-similarity part
+    (WSSMA and WSSMB can also be sparse, as from sparsifyW, in which
+    case their entries are scattered straight into the result)
     :returns: Matrix with them all together
     """
 
     M = WSSMA.shape[0]
     N = WSSMB.shape[0]
     W = np.zeros((N+M, N+M))
-    W[0:M, 0:M] = WSSMA
+    for (WSSM, offset) in [(WSSMA, 0), (WSSMB, M)]:
+        if sparse.issparse(WSSM):
+            WSSM = WSSM.tocoo()
+            W[WSSM.row + offset, WSSM.col + offset] = WSSM.data
+        else:
+            W[offset:offset+WSSM.shape[0], offset:offset+WSSM.shape[0]] = WSSM
     W[0:M, M::] = WCSMAB
     W[M::, 0:M] = WCSMAB.T
-    W[M::, M::] = WSSMB
     return W
 
-def getWCSMSSM(SSMA, SSMB, CSMAB, K, Mu = 0.5):
+def getWCSMSSM(SSMA, SSMB, CSMAB, K, Mu = 0.5, RowsPerChunk = 1000, dtype = np.float64):
     """
     Cross-Affinity Matrix.  Do a special weighting of nearest neighbors
     so that there are a proportional number of similarity neighbors
@@ -83,6 +235,8 @@ def getWCSMSSM(SSMA, SSMB, CSMAB, K, Mu = 0.5):
     :param K: Total number of nearest neighbors per row used
         to tune exponential threshold
     :param Mu: Hyperparameter for nearest neighbors
+    :param RowsPerChunk: Number of rows at a time in getW/getWCSM
+    :param dtype: Type of the result
     :return W: Parent W matrix
     """
     M = SSMA.shape[0]
@@ -92,10 +246,104 @@ def getWCSMSSM(SSMA, SSMB, CSMAB, K, Mu = 0.5):
     k1 = int(K*float(M)/(M+N))
     k2 = K - k1
 
-    WSSMA = getW(SSMA, k1, Mu)
-    WSSMB = getW(SSMB, k2, Mu)
-    WCSMAB = getWCSM(CSMAB, k1, k2, Mu)
-    return setupWCSMSSM(WSSMA, WSSMB, WCSMAB)
+    #Write every part straight into its place in the parent matrix
+    W = np.empty((M+N, M+N), dtype=dtype)
+    getW(SSMA, k1, Mu, out=W[0:M, 0:M], RowsPerChunk=RowsPerChunk)
+    getW(SSMB, k2, Mu, out=W[M::, M::], RowsPerChunk=RowsPerChunk)
+    getWCSM(CSMAB, k1, k2, Mu, out=W[0:M, M::], RowsPerChunk=RowsPerChunk)
+    W[M::, 0:M] = W[0:M, M::].T
+    return W
+
+def getSSMNeighbors(WSSM, K):
+    """
+    Summarize the parts of the rows of an SSM affinity matrix that
+    similarity fusion needs, so that they can be computed once per
+    song and reused for every song it is compared to
+    :param WSSM: (MxM) Affinity matrix, dense or sparse
+    :param K: Number of nearest neighbors
+    :returns {'RowSum': Sum of each row,
+              'J': (M x min(K, M)) Columns of the K largest entries of each row,
+              'V': (M x min(K, M)) Values of those entries}
+    """
+    M = WSSM.shape[0]
+    K = min(K, M)
+    RowSum = np.array(WSSM.sum(1), dtype=np.float64).flatten()
+    if sparse.issparse(WSSM):
+        WSSM = sparseRowTopK(WSSM, K)
+        counts = np.diff(WSSM.indptr)
+        rows = np.repeat(np.arange(M), counts)
+        pos = np.arange(WSSM.nnz) - WSSM.indptr[rows]
+        #Rows with fewer than K neighbors are padded with zeros
+        J = np.zeros((M, K), dtype=np.int64)
+        V = np.zeros((M, K))
+        J[rows, pos] = WSSM.indices
+        V[rows, pos] = WSSM.data
+    else:
+        J = np.argpartition(-WSSM, K-1, 1)[:, 0:K]
+        V = WSSM[np.arange(M)[:, None], J]
+    return {'RowSum':RowSum, 'J':J, 'V':V}
+
+def getPSBlocks(WSSMA, WSSMB, WCSMAB, K, NeighbsA = None, NeighbsB = None):
+    """
+    Compute the P and S matrices of the affinity matrix
+                [ WSSMA      WCSMAB ]
+                [ WCSMBA^T   WSSMB  ]
+    without putting it together first, the way getP and getS
+    would for the result of setupWCSMSSM.  The row sums and the
+    nearest neighbors of the SSM parts can be passed in from
+    getSSMNeighbors, so that they're only computed once per song
+    :param WSSMA: MxM W matrix for upper left SSM part
+    :param WSSMB: NxN W matrix for lower SSM part
+    :param WCSMAB: MxN cross-similarity part
+    :param K: Number of nearest neighbors in S
+    :param NeighbsA: (Optional) getSSMNeighbors(WSSMA, K)
+    :param NeighbsB: (Optional) getSSMNeighbors(WSSMB, K)
+    :returns (P, S): (M+N)x(M+N) dense P matrix and sparse S matrix
+    """
+    M = WSSMA.shape[0]
+    N = WSSMB.shape[0]
+    if NeighbsA is None:
+        NeighbsA = getSSMNeighbors(WSSMA, K)
+    if NeighbsB is None:
+        NeighbsB = getSSMNeighbors(WSSMB, K)
+    RowSumA = NeighbsA['RowSum'] + np.sum(WCSMAB, 1)
+    RowSumB = NeighbsB['RowSum'] + np.sum(WCSMAB, 0)
+    RowSumA[RowSumA == 0] = 1
+    RowSumB[RowSumB == 0] = 1
+    P = np.zeros((M+N, M+N))
+    for (WSSM, offset, RowSum) in [(WSSMA, 0, RowSumA), (WSSMB, M, RowSumB)]:
+        if sparse.issparse(WSSM):
+            WSSM = WSSM.tocoo()
+            P[WSSM.row + offset, WSSM.col + offset] = WSSM.data/RowSum[WSSM.row]
+        else:
+            P[offset:offset+WSSM.shape[0], offset:offset+WSSM.shape[0]] = WSSM/RowSum[:, None]
+    P[0:M, M::] = WCSMAB/RowSumA[:, None]
+    P[M::, 0:M] = WCSMAB.T/RowSumB[:, None]
+
+    #The K nearest neighbors of each row are among the K nearest
+    #in its SSM part and the K nearest in its CSM part
+    I = []
+    J = []
+    V = []
+    for (Neighbs, offset, C, Coffset) in [(NeighbsA, 0, WCSMAB, M), (NeighbsB, M, WCSMAB.T, 0)]:
+        kc = min(K, C.shape[1])
+        JC = np.argpartition(-C, kc-1, 1)[:, 0:kc]
+        VC = C[np.arange(C.shape[0])[:, None], JC]
+        JAll = np.concatenate((Neighbs['J'] + offset, JC + Coffset), 1)
+        VAll = np.concatenate((Neighbs['V'], VC), 1)
+        k = min(K, JAll.shape[1])
+        idx = np.argpartition(-VAll, k-1, 1)[:, 0:k]
+        rows = np.arange(C.shape[0])[:, None]
+        (JAll, VAll) = (JAll[rows, idx], VAll[rows, idx])
+        SNorm = np.sum(VAll, 1)
+        SNorm[SNorm == 0] = 1
+        VAll = VAll/SNorm[:, None]
+        I.append(np.repeat(np.arange(C.shape[0]) + offset, k))
+        J.append(JAll.flatten())
+        V.append(VAll.flatten())
+    [I, J, V] = [np.concatenate(X) for X in [I, J, V]]
+    S = sparse.coo_matrix((V, (I, J)), shape=(M+N, M+N)).tocsr()
+    return (P, S)
 
 def getP(W, diagRegularize = False):
     """
@@ -120,17 +368,22 @@ def getP(W, diagRegularize = False):
         P = W/RowSum[:, None]
         return P
 
-def getS(W, K):
+def getS(W, K, NIndex = None):
     """
     Same thing as P but restricted to K nearest neighbors
         only (using partitions for fast nearest neighbor sets)
     (**note that nearest neighbors here include the element itself)
     :param W: (MxM) similarity matrix
     :param K: Number of neighbors to use per row
+    :param NIndex: (Optional) getNeighborIndex of W with largest=True,
+        with at least K neighbors per row
     :returns S: (MxM) S matrix
     """
     N = W.shape[0]
-    J = np.argpartition(-W, K, 1)[:, 0:K]
+    if NIndex is None or NIndex['RowJ'].shape[1] < K:
+        J = np.argpartition(-W, K, 1)[:, 0:K]
+    else:
+        J = NIndex['RowJ'][:, 0:K]
     I = np.tile(np.arange(N)[:, None], (1, K))
     V = W[I.flatten(), J.flatten()]
     #Now figure out L1 norm of each row
@@ -143,7 +396,7 @@ def getS(W, K):
     return S
 
 
-def doSimilarityFusionWs(Ws, K = 5, NIters = 20, reg = 1, PlotNames = [], verboseTimes = False):
+def doSimilarityFusionWs(Ws, K = 5, NIters = 20, reg = 1, PlotNames = [], verboseTimes = False, tol = 0, retInfo = False, NThreads = 1):
     """
     Perform similarity fusion between a set of exponentially
     weighted similarity matrices
@@ -155,6 +408,20 @@ def doSimilarityFusionWs(Ws, K = 5, NIters = 20, reg = 1, PlotNames = [], verbos
     :param PlotNames: Strings describing different similarity
         measurements. If this array is specified, an
         animation will be saved of the cross-diffusion process
+    :param tol: If > 0, stop before NIters once the relative change
+        of the fused matrix from one iteration to the next drops below
+        tol.  The change is measured as ||D_t/||D_t|| - D_{t-1}/||D_{t-1}|| ||
+        (Frobenius norms), which ignores the steady growth in scale
+        that comes from the regularization
+    :param retInfo: If True, also return a dictionary with the number
+        of iterations that were run ('NIters') and the relative change
+        of the fused matrix in the last one ('Residual')
+    :param NThreads: Number of threads with which to update the views
+        of each iteration concurrently.  Every view is updated from the
+        previous iteration's matrices, so the result does not depend
+        on the number of threads.  BLAS is limited to one thread per
+        view while they run if threadpoolctl is installed, so that the
+        threads don't oversubscribe the cores
     :return D: A fused NxN similarity matrix
     """
     tic = time.time()
@@ -162,69 +429,379 @@ def doSimilarityFusionWs(Ws, K = 5, NIters = 20, reg = 1, PlotNames = [], verbos
     Ps = [getP(W) for W in Ws]
     #Nearest neighbor truncated matrices
     Ss = [getS(W, K) for W in Ws]
-
-    #Now do cross-diffusion iterations
-    Pts = [np.array(P) for P in Ps]
-    nextPts = [np.zeros(P.shape) for P in Pts]
     if verboseTimes:
         print("Time getting Ss and Ps: %g"%(time.time() - tic))
+    return doSimilarityFusionPS(Ps, Ss, NIters, reg, PlotNames, verboseTimes, tol, retInfo, NThreads)
 
+def doSimilarityFusionPS(Ps, Ss, NIters = 20, reg = 1, PlotNames = [], verboseTimes = False, tol = 0, retInfo = False, NThreads = 1):
+    """
+    Perform similarity fusion starting from the probability
+    matrices and the nearest neighbor matrices of each view
+    :param Ps: An array of NxN probability matrices, as from getP
+    :param Ss: An array of NxN sparse nearest neighbor matrices,
+        as from getS
+    Other parameters the same as doSimilarityFusionWs
+    :return D: A fused NxN similarity matrix
+    """
+    #Now do cross-diffusion iterations.  Pts holds this iteration's
+    #matrices and nextPts the next one's, and the two lists are
+    #swapped after each iteration so that no view is updated from
+    #a matrix that has already moved on to the next iteration
+    Pts = [np.array(P) for P in Ps]
+    nextPts = [None for P in Pts]
+    #The average of all of the other views is the total minus
+    #this view, so each iteration only needs O(N) additions
+    Total = np.zeros(Pts[0].shape)
+    Other = np.zeros(Pts[0].shape)
     N = len(Pts)
+    np.copyto(Total, Pts[0])
+    for k in range(1, N):
+        Total += Pts[k]
+    #Each thread updates its own group of views, one after the other,
+    #so each thread needs one buffer for the average of the others
+    NThreads = max(1, min(NThreads, N))
+    Buffers = []
+    if NThreads > 1:
+        Buffers = [np.zeros(Pts[0].shape) for t in range(NThreads)]
     AllTimes = []
-    for it in range(NIters):
-        if len(PlotNames) == N:
-            k = int(np.ceil(np.sqrt(N)))
-            for i in range(N):
-                plt.subplot(k, k, i+1)
-                Im = 1.0*Pts[i]
-                Idx = np.arange(Im.shape[0], dtype=np.int64)
-                Im[Idx, Idx] = 0
-                if Im.shape[0] > 400:
-                    Im = interp.zoom(Im, 400.0/Im.shape[0])
-                plt.imshow(Im, interpolation = 'none', cmap = 'afmhot')
-                plt.title(PlotNames[i])
-                plt.axis('off')
-            plt.savefig("SSMFusion%i.png"%it, dpi=150, bbox_inches='tight')
-        for i in range(N):
-            nextPts[i] *= 0
-            tic = time.time()
-            for k in range(N):
-                if i == k:
-                    continue
-                nextPts[i] += Pts[k]
-            nextPts[i] /= float(N-1)
-
-            #tic = time.time()
-            #nextPts[i] = SsD[i].dot(nextPts[i].dot(SsD[i].T))
-            #toc = time.time()
-            #print(toc - tic, " ")
-
-            #Need S*P*S^T, but have to multiply sparse matrix on the left
-            tic = time.time()
-            A = Ss[i].dot(nextPts[i].T)
-            nextPts[i] = Ss[i].dot(A.T)
-            toc = time.time()
-            AllTimes.append(toc - tic)
 
-            if reg > 0:
-                nextPts[i] += reg*np.eye(nextPts[i].shape[0])
+    def updateView(i, Buffer):
+        np.subtract(Total, Pts[i], out=Buffer)
+        Buffer /= float(N-1)
 
-        Pts = nextPts
+        #Need S*P*S^T, but have to multiply sparse matrix on the left
+        tic = time.time()
+        A = Ss[i].dot(Buffer.T)
+        nextPts[i] = Ss[i].dot(A.T)
+        toc = time.time()
+        AllTimes.append(toc - tic)
+
+        if reg > 0:
+            nextPts[i].flat[::nextPts[i].shape[0]+1] += reg
+
+    def updateViews(t):
+        for i in range(t, N, NThreads):
+            updateView(i, Buffers[t])
+
+    Info = {'NIters':0, 'Residual':np.inf}
+    with ExitStack() as stack:
+        pool = None
+        if NThreads > 1:
+            pool = stack.enter_context(ThreadPoolExecutor(NThreads))
+            #Keep BLAS to one thread per view so the threads don't oversubscribe
+            if threadpool_limits:
+                stack.enter_context(threadpool_limits(limits=1, user_api='blas'))
+        for it in range(NIters):
+            if len(PlotNames) == N:
+                k = int(np.ceil(np.sqrt(N)))
+                for i in range(N):
+                    plt.subplot(k, k, i+1)
+                    Im = 1.0*Pts[i]
+                    Idx = np.arange(Im.shape[0], dtype=np.int64)
+                    Im[Idx, Idx] = 0
+                    if Im.shape[0] > 400:
+                        Im = interp.zoom(Im, 400.0/Im.shape[0])
+                    plt.imshow(Im, interpolation = 'none', cmap = 'afmhot')
+                    plt.title(PlotNames[i])
+                    plt.axis('off')
+                plt.savefig("SSMFusion%i.png"%it, dpi=150, bbox_inches='tight')
+            if pool:
+                list(pool.map(updateViews, range(NThreads)))
+            else:
+                for i in range(N):
+                    updateView(i, Other)
+
+            (Pts, nextPts) = (nextPts, Pts)
+            #Other is free until the next iteration, so use it
+            #to remember the last total
+            (Other, Total) = (Total, Other)
+            np.copyto(Total, Pts[0])
+            for k in range(1, N):
+                Total += Pts[k]
+            Info['NIters'] = it+1
+            if tol > 0 or retInfo:
+                NormTotal = np.sqrt(np.vdot(Total, Total))
+                Other *= -NormTotal/np.sqrt(np.vdot(Other, Other))
+                Other += Total
+                Info['Residual'] = np.sqrt(np.vdot(Other, Other))/NormTotal
+                if Info['Residual'] < tol:
+                    break
     if verboseTimes:
         print("Total Time multiplying: %g"%np.sum(np.array(AllTimes)))
-    FusedScores = np.zeros(Pts[0].shape)
-    for Pt in Pts:
-        FusedScores += Pt
-    return FusedScores/N
+        print("%i iterations, residual %g"%(Info['NIters'], Info['Residual']))
+    if retInfo:
+        return (Total/N, Info)
+    return Total/N
+
+def sparseRowTopK(A, KeepK = None, MassTol = 0):
+    """
+    Truncate each row of a sparse nonnegative matrix to its largest
+    entries.  At most KeepK entries are kept in each row, and beyond
+    that, the smallest entries are dropped as long as the total that
+    is dropped from a row stays within MassTol of the row's sum
+    :param A: (NxN) Sparse matrix with nonnegative entries
+    :param KeepK: Maximum number of entries per row (None for no limit)
+    :param MassTol: Fraction of each row's L1 mass that may be dropped
+    :returns: (NxN) Truncated CSR matrix
+    """
+    N = A.shape[0]
+    RowSum = np.array(A.sum(1), dtype=np.float64).flatten()
+    if KeepK is not None and sparse.issparse(A):
+        #Lay out the rows of A side by side, padded with -1, so that
+        #they can be cut down to KeepK entries with one partition
+        A = sparse.csr_matrix(A)
+        counts = np.diff(A.indptr)
+        if A.nnz > 0 and np.max(counts) > KeepK:
+            rows = np.repeat(np.arange(N), counts)
+            pos = np.arange(A.nnz) - A.indptr[rows]
+            Pad = -np.ones((N, np.max(counts)), dtype=A.dtype)
+            Pad[rows, pos] = A.data
+            Cols = np.zeros(Pad.shape, dtype=A.indices.dtype)
+            Cols[rows, pos] = A.indices
+            A = Pad
+        else:
+            Cols = None
+        if Cols is not None:
+            J = np.argpartition(-A, KeepK-1, 1)[:, 0:KeepK]
+            I = np.arange(N)[:, None]
+            (A, Cols) = (A[I, J], Cols[I, J])
+            A[A < 0] = 0
+            A = sparse.csr_matrix((A.flatten(), Cols.flatten(), KeepK*np.arange(N+1)), shape=(N, N))
+    elif KeepK is not None and KeepK < A.shape[1]:
+        #Cut dense rows down to KeepK entries before sorting anything
+        J = np.argpartition(-A, KeepK-1, 1)[:, 0:KeepK]
+        I = np.arange(N)[:, None]
+        A = sparse.csr_matrix((A[I, J].flatten(), J.flatten(), KeepK*np.arange(N+1)), shape=A.shape)
+    A = sparse.csr_matrix(A)
+    counts = np.diff(A.indptr)
+    rows = np.repeat(np.arange(N), counts)
+    #Sort entries by row, and then from largest to smallest in each
+    #row, with one key whose integer part is the row and whose
+    #fractional part decreases with the value
+    RowMax = np.ones(N)
+    if A.nnz > 0:
+        RowMax[counts > 0] = np.maximum.reduceat(A.data, A.indptr[0:-1][counts > 0])
+    RowMax[RowMax <= 0] = 1
+    order = np.argsort(rows + 0.5*(1 - A.data/RowMax[rows]), kind='stable')
+    rows = rows[order]
+    cols = A.indices[order]
+    vals = A.data[order]
+    rank = np.arange(len(vals)) - A.indptr[rows]
+    keep = vals > 0
+    if KeepK is not None:
+        keep *= rank < KeepK
+    if MassTol > 0:
+        #Keep an entry if the ones before it in its row
+        #don't yet make up 1-MassTol of the row sum
+        cumsum = np.cumsum(vals, dtype=np.float64)
+        rowstart = np.concatenate(([0], cumsum))[A.indptr[rows]]
+        before = cumsum - vals - rowstart
+        keep *= before < (1-MassTol)*RowSum[rows]
+    #Entries are still in row order, so the result can be put
+    #together directly in CSR form
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[keep], minlength=N))))
+    return sparse.csr_matrix((vals[keep], cols[keep], indptr), shape=A.shape)
+
+def doSimilarityFusionWsSparse(Ws, K = 5, NIters = 20, reg = 1, KeepK = None, MassTol = 1e-4, dtype = np.float32, tol = 0, retInfo = False):
+    """
+    Perform similarity fusion between a set of exponentially
+    weighted similarity matrices, like doSimilarityFusionWs, but
+    keep the diffused P matrices sparse by truncating each of their
+    rows after every iteration (see sparseRowTopK), and do all of
+    the products sparse times sparse in single precision.  With
+    MassTol = 0 and no KeepK, this gives the same result as
+    doSimilarityFusionWs up to rounding
+    :param Ws: An array of NxN affinity matrices for N songs
+        (dense, or sparse as from sparsifyW)
+    :param K: Number of nearest neighbors
+    :param NIters: Number of iterations
+    :param reg: Identity matrix regularization parameter for
+        self-similarity promotion
+    :param KeepK: Maximum number of entries kept in each row of
+        the diffused matrices (None for no limit)
+    :param MassTol: Fraction of the mass of each row of the diffused
+        matrices that may be dropped after each iteration
+    :param dtype: Type in which to do the computations
+    :param tol, retInfo: Early stopping (see doSimilarityFusionWs)
+    :return D: A fused NxN similarity matrix
+    """
+    Ps = []
+    Ss = []
+    for W in Ws:
+        if sparse.issparse(W):
+            W = W.toarray()
+        Ps.append(getP(W))
+        Ss.append(getS(W, K))
+    return doSimilarityFusionPSSparse(Ps, Ss, NIters, reg, KeepK, MassTol, dtype, tol, retInfo)
+
+def doSimilarityFusionPSSparse(Ps, Ss, NIters = 20, reg = 1, KeepK = None, MassTol = 1e-4, dtype = np.float32, tol = 0, retInfo = False, retSparse = False):
+    """
+    The sparse version of doSimilarityFusionPS.  Parameters are
+    the same as doSimilarityFusionWsSparse, except that the
+    probability matrices Ps and the nearest neighbor matrices Ss
+    of each view are given instead of the affinity matrices
+    (Ps can be dense or sparse)
+    :param retSparse: If True, return the fused matrix as a sparse
+        CSR matrix instead of a dense array
+    :return D: A fused NxN similarity matrix
+    """
+    Ss = [S.astype(dtype) for S in Ss]
+    Pts = [sparseRowTopK(P.astype(dtype), KeepK, MassTol) for P in Ps]
+    N = len(Pts)
+    I = reg*sparse.identity(Pts[0].shape[0], dtype=dtype, format='csr')
+    Total = Pts[0]
+    for k in range(1, N):
+        Total = Total + Pts[k]
+    Info = {'NIters':0, 'Residual':np.inf}
+    for it in range(NIters):
+        nextPts = []
+        for i in range(N):
+            nextPt = (Total - Pts[i])/float(N-1)
+            #Truncate S*P before multiplying by S^T to limit fill in
+            nextPt = sparseRowTopK(Ss[i].dot(nextPt), KeepK, MassTol)
+            nextPt = nextPt.dot(Ss[i].T)
+            if reg > 0:
+                nextPt = nextPt + I
+            nextPts.append(sparseRowTopK(nextPt, KeepK, MassTol))
+        Pts = nextPts
+        LastTotal = Total
+        Total = Pts[0]
+        for k in range(1, N):
+            Total = Total + Pts[k]
+        Info['NIters'] = it+1
+        if tol > 0 or retInfo:
+            Info['Residual'] = sparse.linalg.norm(Total/sparse.linalg.norm(Total) - LastTotal/sparse.linalg.norm(LastTotal))
+            if Info['Residual'] < tol:
+                break
+    if retSparse:
+        Total = Total/N
+    else:
+        Total = Total.toarray()/N
+    if retInfo:
+        return (Total, Info)
+    return Total
+
+def getWSparseChunked(D, K, KeepK = None, RowsPerChunk = 1000, Mu = 0.5, Transform = None, Symmetric = True, dtype = np.float32):
+    """
+    Compute the same affinities as getW, but only between each row and
+    its KeepK nearest neighbors, reading D a chunk of rows at a time so
+    that it never has to be in memory all at once (e.g. when it is a
+    memory mapped score matrix)
+    :param D: NxN dissimilarity matrix (anything that can be sliced by rows)
+    :param K: Number of nearest neighbors used for the neighborhood radii
+    :param KeepK: Number of neighbors to keep in each row (default 2K,
+        and at least K+1)
+    :param RowsPerChunk: Number of rows of D to read at once
+    :param Mu: Nearest neighbor hyperparameter (default 0.5)
+    :param Transform: (Optional) Function to apply to each chunk of D as
+        it's read, e.g. to turn similarity scores into distances
+    :param Symmetric: If False, average D with its transpose like getW
+        does, by reading columns as well as rows.  If True, D is taken
+        to be symmetric already, as the batch score matrices are
+    :param dtype: Type in which to store the affinities
+    :returns W: (NxN) Sparse CSR affinity matrix, symmetrized by taking
+        the union of the neighbor sets
+    """
+    N = D.shape[0]
+    if KeepK is None:
+        KeepK = 2*K
+    KeepK = min(max(KeepK, K+1), N)
+    J = np.zeros((N, KeepK), dtype=np.int64)
+    V = np.zeros((N, KeepK))
+    for i1 in range(0, N, RowsPerChunk):
+        i2 = min(i1+RowsPerChunk, N)
+        X = np.array(D[i1:i2, :], dtype=np.float64)
+        if Transform:
+            X = Transform(X)
+        if not Symmetric:
+            XT = np.array(D[:, i1:i2], dtype=np.float64).T
+            if Transform:
+                XT = Transform(XT)
+            X = 0.5*(X + XT)
+        rows = np.arange(i2-i1)[:, None]
+        X[rows.flatten(), np.arange(i1, i2)] = 0
+        #Sort each row's neighbors so the K+1 nearest come first
+        idx = np.argpartition(X, KeepK-1, 1)[:, 0:KeepK]
+        vals = X[rows, idx]
+        order = np.argsort(vals, 1)
+        J[i1:i2, :] = idx[rows, order]
+        V[i1:i2, :] = vals[rows, order]
+    #Equation 1 in SNF paper [2], just like getW
+    MeanDist = np.mean(V[:, 0:K+1], 1)*float(K+1)/float(K)
+    Eps = (MeanDist[:, None] + MeanDist[J] + V)/3
+    V = np.exp(-V**2/(2*(Mu*Eps)**2))
+    I = np.repeat(np.arange(N), KeepK)
+    W = sparse.coo_matrix((V.flatten(), (I, J.flatten())), shape=(N, N)).tocsr()
+    W = W.maximum(W.T)
+    return W.astype(dtype).tocsr()
+
+def getPSSparse(W, K):
+    """
+    Compute the P and S matrices of a sparse affinity matrix, like
+    getP and getS do for a dense one.  The rows of P are normalized
+    over the entries that were kept in W
+    :param W: (NxN) Sparse affinity matrix
+    :param K: Number of neighbors to use per row in S
+    :returns (P, S): (NxN) Sparse CSR matrices
+    """
+    W = sparse.csr_matrix(W)
+    P = sparse.diags(getSparseRowScale(W)).dot(W).tocsr()
+    S = sparseRowTopK(W, K)
+    S = sparse.diags(getSparseRowScale(S)).dot(S).tocsr()
+    return (P, S)
+
+def getSparseRowScale(W):
+    RowSum = np.array(W.sum(1), dtype=np.float64).flatten()
+    RowSum[RowSum == 0] = 1
+    return (1.0/RowSum).astype(W.dtype)
+
+def doSimilarityFusionSparseKNN(Scores, K = 5, NIters = 20, reg = 1, KeepK = None, OutK = None, RowsPerChunk = 1000, Transform = None, MassTol = 1e-4, tol = 0, retInfo = False):
+    """
+    Do similarity fusion on a set of NxN distance matrices that may be
+    too big to fit in memory, such as memory mapped score matrices over
+    a whole catalog.  Each one is streamed from disk into a sparse
+    kNN affinity graph (getWSparseChunked), and the diffusion is done
+    on those with doSimilarityFusionPSSparse, so nothing NxN is ever
+    held densely
+    :param Scores: List of NxN symmetric distance matrices
+    :param K: Number of nearest neighbors
+    :param NIters: Number of iterations
+    :param reg: Identity matrix regularization parameter
+    :param KeepK: Number of neighbors kept in each row of the
+        affinity graphs and the diffused matrices (default 2K)
+    :param OutK: If specified, keep only this many of the
+        largest entries in each row of the result
+    :param RowsPerChunk: Number of rows to read at once
+    :param Transform: (Optional) Function to apply to each chunk of
+        the score matrices as it's read (see getWSparseChunked)
+    :param MassTol: See sparseRowTopK
+    :param tol, retInfo: Early stopping (see doSimilarityFusionWs)
+    :returns D: A fused NxN similarity matrix, as a sparse CSR matrix
+    """
+    if KeepK is None:
+        KeepK = 2*K
+    Ps = []
+    Ss = []
+    for D in Scores:
+        W = getWSparseChunked(D, K, KeepK, RowsPerChunk, Transform = Transform)
+        (P, S) = getPSSparse(W, K)
+        Ps.append(P)
+        Ss.append(S)
+    (D, Info) = doSimilarityFusionPSSparse(Ps, Ss, NIters, reg, KeepK, MassTol, tol = tol, retInfo = True, retSparse = True)
+    if OutK is not None:
+        D = sparseRowTopK(D, OutK)
+    if retInfo:
+        return (D, Info)
+    return D
 
-def doSimilarityFusion(Scores, K = 5, NIters = 20, reg = 1, PlotNames = []):
+def doSimilarityFusion(Scores, K = 5, NIters = 20, reg = 1, PlotNames = [], tol = 0, retInfo = False, NThreads = 1):
     """
     Do similarity fusion on a set of NxN distance matrices.
     Parameters the same as doSimilarityFusionWs
     """
     #Affinity matrices
     Ws = [getW(D, K) for D in Scores]
-    return doSimilarityFusionWs(Ws, K, NIters, reg, PlotNames)
+    return doSimilarityFusionWs(Ws, K, NIters, reg, PlotNames, tol = tol, retInfo = retInfo, NThreads = NThreads)
 
 if __name__ == '__main__':
     fout = open("Covers80ResultsFinal.html", "a")
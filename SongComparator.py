@@ -41,7 +41,7 @@ def makeISMIRPlot(AllDs, fileprefix, song1name, song2name):
     plotSongLabels(song1name, song2name, 1, NSubplots)
     plt.savefig("%s.svg"%fileprefix, bbox_inches = 'tight')
 
-def compareTwoFeatureSets(Results, Features1, O1, Features2, O2, CSMTypes, Kappa, fileprefix, NIters = 3, K = 20, song1name = 'Song 1', song2name = 'Song 2'):
+def compareTwoFeatureSets(Results, Features1, O1, Features2, O2, CSMTypes, Kappa, fileprefix, NIters = 3, K = 20, song1name = 'Song 1', song2name = 'Song 2', NThreads = 1):
     plt.figure(figsize=(18, 5))
     #Do each feature individually
     AllDs = []
@@ -69,7 +69,7 @@ def compareTwoFeatureSets(Results, Features1, O1, Features2, O2, CSMTypes, Kappa
 
     #Do cross-similarity fusion
     plt.clf()
-    res = getCSMSmithWatermanScoresEarlyFusionFull(Features1, O1, Features2, O2, Kappa, K, NIters, CSMTypes, True)
+    res = getCSMSmithWatermanScoresEarlyFusionFull(Features1, O1, Features2, O2, Kappa, K, NIters, CSMTypes, True, NThreads = NThreads)
     plt.clf()
     Results['CSMFused'] = res['CSM']
     plt.subplot(131)
@@ -90,7 +90,7 @@ def compareTwoFeatureSets(Results, Features1, O1, Features2, O2, CSMTypes, Kappa
 
     sio.savemat("%s.mat"%fileprefix, Results)
 
-def compareTwoSongs(filename1, TempoBias1, filename2, TempoBias2, hopSize, FeatureParams, CSMTypes, Kappa, fileprefix, song1name = 'Song 1', song2name = 'Song 2'):
+def compareTwoSongs(filename1, TempoBias1, filename2, TempoBias2, hopSize, FeatureParams, CSMTypes, Kappa, fileprefix, song1name = 'Song 1', song2name = 'Song 2', NThreads = 1):
     from pyMIRBasic.AudioIO import getAudioLibrosa
     from pyMIRBasic.Onsets import getBeats
     print("Getting features for %s..."%filename1)
@@ -109,7 +109,7 @@ def compareTwoSongs(filename1, TempoBias1, filename2, TempoBias2, hopSize, Featu
 
     Results = {'filename1':filename1, 'filename2':filename2, 'TempoBias1':TempoBias1, 'TempoBias2':TempoBias2, 'hopSize':hopSize, 'FeatureParams':FeatureParams, 'CSMTypes':CSMTypes, 'Kappa':Kappa}
 
-    compareTwoFeatureSets(Results, Features1, O1, Features2, O2, CSMTypes, Kappa, fileprefix, song1name = song1name, song2name = song2name)
+    compareTwoFeatureSets(Results, Features1, O1, Features2, O2, CSMTypes, Kappa, fileprefix, song1name = song1name, song2name = song2name, NThreads = NThreads)
 
 #Modify the main function below to try on songs of your choice
 if __name__ == '__main__':
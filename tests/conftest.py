@@ -0,0 +1,53 @@
+"""
+Shared fixtures for the tests, which build a small synthetic
+collection of precomputed song features in a scratch directory
+"""
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import numpy as np
+import scipy.io as sio
+import pytest
+from BatchCollection import *
+
+CSMTypes = {'MFCCs':'Euclidean', 'SSMs':'Euclidean', 'Chromas':'CosineOTI'}
+Kappa = 0.1
+
+def makeSong(rng, NBeats):
+    """
+    Make random features for a song at one to three tempo levels,
+    in the same format as precomputeBatchFeatures saves them
+    """
+    ret = {'hopSize':512, 'winSize':11025, 'lifterexp':0.6}
+    NTempos = rng.integers(1, 4)
+    for t in range(NTempos):
+        nb = int(NBeats*(1+0.5*t))
+        Feats = {'MFCCs':rng.standard_normal((nb, 40)),
+                 'SSMs':rng.standard_normal((nb, 30)),
+                 'Chromas':np.abs(rng.standard_normal((nb, 24)))}
+        O = {'ChromaMean':np.abs(rng.standard_normal(12))}
+        ret['ChromaMean%i'%t] = O['ChromaMean']
+        ret['tempos%i'%t] = 60.0*(t+1)+rng.random()
+        ret['beats%i'%t] = np.arange(nb+1)*10
+        for F in Feats:
+            ret['%s%i'%(F, t)] = Feats[F]
+            SSM = getCSMType(Feats[F], O, Feats[F], O, CSMTypes[F])
+            ret['W%s%i'%(F, t)] = getW(SSM, int(0.5*Kappa*SSM.shape[0]))
+    ret['NTempos'] = NTempos
+    return ret
+
+def makeCollection(scratchDir, N = 5, seed = 0):
+    """
+    Save the features of N random songs to a scratch directory
+    :returns allFiles: The (nonexistent) audio files of the songs
+    """
+    rng = np.random.default_rng(seed)
+    allFiles = ['dir%i/song%i.mp3'%(i%2, i) for i in range(N)]
+    for f in allFiles:
+        sio.savemat(getMatFilename(scratchDir, f), makeSong(rng, rng.integers(30, 60)))
+    return allFiles
+
+@pytest.fixture
+def collection(tmp_path):
+    scratchDir = str(tmp_path)
+    return (scratchDir, makeCollection(scratchDir))
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+from conftest import CSMTypes, Kappa
+from BatchCollection import *
+
+def compareBlock(scratchDir, allFiles, idxs, BlockParams):
+    Ds = compareBatchBlock((idxs, Kappa, CSMTypes, allFiles, scratchDir, BlockParams))
+    Filename = getBatchBlockFilename(scratchDir, idxs, Kappa, CSMTypes, BlockParams)
+    return (Filename, Ds)
+
+def test_block_options_change_filename_and_scores(collection):
+    (scratchDir, allFiles) = collection
+    idxs = [0, 3, 0, 3]
+    (f1, D1) = compareBlock(scratchDir, allFiles, idxs, {})
+    (f2, D2) = compareBlock(scratchDir, allFiles, idxs, {'FusionEngine':'Sparse', 'FusionKeepK':5})
+    assert f1 != f2
+    assert os.path.exists(f1) and os.path.exists(f2)
+    assert not np.allclose(D1['SNF'], D2['SNF'])
+    #Rerunning with the first options reuses its own block
+    (f3, D3) = compareBlock(scratchDir, allFiles, idxs, {})
+    assert f3 == f1
+    assert np.array_equal(D1['SNF'], D3['SNF'])
+
+def test_block_filename_kappa(collection):
+    (scratchDir, allFiles) = collection
+    idxs = [0, 3, 0, 3]
+    Options = {'CSMDtype':'float32'}
+    f1 = getBatchBlockFilename(scratchDir, idxs, 0.1, CSMTypes, Options)
+    f2 = getBatchBlockFilename(scratchDir, idxs, 0.2, CSMTypes, Options)
+    assert f1 != f2
+    assert getBatchBlockFilename(scratchDir, idxs, 0.1, CSMTypes, {}).endswith("D0_3_0_3.mat")
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import SequenceAlignment.SequenceAlignment as SA
+from CSMSSMTools import *
+
+@pytest.mark.parametrize("shape", [(1, 1), (5, 3), (17, 9), (23, 64), (40, 71)])
+@pytest.mark.parametrize("density", [0.0, 0.1, 0.5, 1.0])
+def test_sw_packed_matches_unpacked(shape, density):
+    rng = np.random.default_rng(shape[0]*shape[1])
+    B = np.array(rng.random(shape) < density, dtype=np.float64)
+    ref = SAC.swalignimpconstrained(B)
+    assert getSWScore(packCSM(B)) == ref
+    assert getSWScore(B) == ref
+    if B.size < 1000:
+        assert ref == SA.swalignimpconstrained(B)[0]
+
+def test_packed_csm_ops():
+    rng = np.random.default_rng(1)
+    A = rng.random((13, 21)) < 0.3
+    B = rng.random((13, 21)) < 0.3
+    assert np.array_equal((packCSM(A) | packCSM(B)).toarray() > 0, A | B)
+    assert np.array_equal((packCSM(A) & packCSM(B)).toarray() > 0, A & B)
+
+def test_binary_mutual_packed_matches_dense():
+    rng = np.random.default_rng(2)
+    D = rng.random((60, 45))
+    B = CSMToBinaryMutual(D, 0.1)
+    assert np.array_equal(CSMToBinaryMutual(D, 0.1, packed = True).toarray() > 0, B > 0)
+
+@pytest.mark.parametrize("TileSize", [7, 64, CSM_TILE_SIZE])
+def test_csm_tiled_matches_getcsm(TileSize):
+    rng = np.random.default_rng(3)
+    X = rng.standard_normal((300, 20))
+    Y = rng.standard_normal((170, 20))
+    ref = getCSM(X, Y)
+    D = getCSMTiled(X, Y, TileSize = TileSize, dtype = np.float64)
+    assert np.allclose(D, ref, rtol = 1e-10, atol = 1e-10)
+    D = getCSMTiled(X, Y, TileSize = TileSize)
+    assert D.dtype == np.float32
+    assert np.allclose(D, ref, rtol = 1e-4, atol = 1e-3)
+
+def test_csm_cosine_all_oti():
+    rng = np.random.default_rng(4)
+    (NBins, PerBlock) = (12, 5)
+    X = np.abs(rng.standard_normal((90, NBins*PerBlock)))
+    Y = np.abs(rng.standard_normal((70, NBins*PerBlock)))
+    (C1, C2) = (rng.random(NBins), rng.random(NBins))
+    (DGlobal, DLocal) = getCSMCosineAllOTI(X, Y, C1, C2, TileBytes = 8*NBins*70*11)
+    assert np.allclose(DGlobal, getCSMCosineOTI(X, Y, C1, C2), atol = 1e-12)
+    Ds = []
+    for oti in range(NBins):
+        XR = np.reshape(np.roll(np.reshape(X, (90, PerBlock, NBins)), oti, axis=2), X.shape)
+        Ds.append(getCSMCosine(XR, Y))
+    assert np.allclose(DLocal, np.min(np.array(Ds), 0), atol = 1e-12)
+
+def test_csm_emd1d():
+    rng = np.random.default_rng(5)
+    X = rng.random((50, 12))
+    Y = rng.random((40, 12))
+    ref = np.sum(np.abs(np.cumsum(X, 1)[:, None, :] - np.cumsum(Y, 1)[None, :, :]), 2)
+    assert np.allclose(getCSMEMD1D(X, Y, TileBytes = 1000), ref)
@@ -0,0 +1,34 @@
+import os
+import time
+from conftest import CSMTypes
+from FeatureCache import *
+
+def test_stale_lock_broken(tmp_path):
+    scratchDir = str(tmp_path)
+    os.makedirs(getFeatureCacheDir(scratchDir))
+    lockfile = "%s/manifest.lock"%getFeatureCacheDir(scratchDir)
+    fout = open(lockfile, 'w')
+    fout.write("deadhost_1")
+    fout.close()
+    os.utime(lockfile, (0, 0))
+    lockFeatureCacheManifest(scratchDir)
+    assert getLockFileOwner(lockfile) == getManifestLockOwner()
+    assert not os.path.exists("%s.break"%lockfile)
+    unlockFeatureCacheManifest(scratchDir)
+    assert not os.path.exists(lockfile)
+
+def test_touch_keeps_entries_from_garbage_collection(tmp_path):
+    scratchDir = str(tmp_path)
+    Params = {'hopSize':512, 'CSMTypes':CSMTypes}
+    FeatureFiles = resolveFeatureCache(scratchDir, ['a.mp3', 'b.mp3'], Params)
+    for f in FeatureFiles:
+        open(f, 'w').close()
+    #Pretend the run started two days ago
+    Manifest = loadFeatureCacheManifest(scratchDir)
+    for entry in Manifest['entries'].values():
+        entry['lastUsed'] -= 2*24*3600
+    saveFeatureCacheManifest(scratchDir, Manifest)
+    touchFeatureCache(scratchDir, FeatureFiles[0:1])
+    assert collectFeatureCacheGarbage(scratchDir, maxAgeDays = 1) == 1
+    assert os.path.exists(FeatureFiles[0])
+    assert not os.path.exists(FeatureFiles[1])
@@ -0,0 +1,41 @@
+import os
+import numpy as np
+from multiprocessing import Pool as PPool
+from conftest import makeCollection
+from BatchCollection import *
+
+def packFeatureStoreArgs(args):
+    packFeatureStore(*args)
+
+def checkStore(scratchDir, allFiles):
+    for f in allFiles:
+        filename = getMatFilename(scratchDir, f)
+        Features = getStoreFeatures(openFeatureStore(scratchDir), filename)
+        for name, val in sio.loadmat(filename).items():
+            if name.startswith('__'):
+                continue
+            assert np.array_equal(np.array(Features[name]).squeeze(), val.squeeze())
+
+def test_concurrent_pack(tmp_path):
+    scratchDir = str(tmp_path)
+    allFiles = makeCollection(scratchDir, N = 8)
+    matfiles = [getMatFilename(scratchDir, f) for f in allFiles]
+    #Two experiments packing overlapping sets of songs at the same time
+    args = [(scratchDir, matfiles[0:6]), (scratchDir, matfiles[2:8])]*2
+    with PPool(4) as pool:
+        pool.map(packFeatureStoreArgs, args)
+    checkStore(scratchDir, allFiles)
+
+def test_store_removed(tmp_path):
+    scratchDir = str(tmp_path)
+    allFiles = makeCollection(scratchDir, N = 3)
+    matfiles = [getMatFilename(scratchDir, f) for f in allFiles]
+    packFeatureStore(scratchDir, matfiles)
+    assert openFeatureStore(scratchDir) is not None
+    (binfilename, indexfilename) = getFeatureStorePaths(scratchDir)
+    os.remove(binfilename)
+    assert openFeatureStore(scratchDir) is None
+    #Features fall back to the .mat files, and packing starts over
+    assert getBatchFeatures(scratchDir, matfiles[0])['NTempos'] == sio.loadmat(matfiles[0])['NTempos']
+    packFeatureStore(scratchDir, matfiles)
+    checkStore(scratchDir, allFiles)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from SimilarityFusion import *
+
+def getRandomW(rng, N, K):
+    X = rng.standard_normal((N, 5))
+    D = np.sqrt(np.sum((X[:, None, :] - X[None, :, :])**2, 2))
+    return getW(D, K)
+
+def doSimilarityFusionPSReference(Ps, Ss, NIters, reg):
+    """
+    Straightforward cross-diffusion, updating every view from
+    the views of the previous iteration
+    """
+    Pts = [np.array(P) for P in Ps]
+    N = len(Pts)
+    for it in range(NIters):
+        nextPts = []
+        for i in range(N):
+            Other = sum([Pts[k] for k in range(N) if not k == i])/float(N-1)
+            S = Ss[i].toarray()
+            nextPts.append(S.dot(Other).dot(S.T) + reg*np.eye(Other.shape[0]))
+        Pts = nextPts
+    return sum(Pts)/N
+
+@pytest.mark.parametrize("NThreads", [1, 2, 3])
+def test_fusion_matches_reference(NThreads):
+    rng = np.random.default_rng(0)
+    Ws = [getRandomW(rng, 80, 10) for i in range(4)]
+    Ps = [getP(W) for W in Ws]
+    Ss = [getS(W, 10) for W in Ws]
+    ref = doSimilarityFusionPSReference(Ps, Ss, 5, 1)
+    D = doSimilarityFusionPS(Ps, Ss, 5, 1, NThreads = NThreads)
+    assert np.allclose(D, ref, rtol = 1e-12, atol = 1e-14)
+    (D, Info) = doSimilarityFusionWs(Ws, 10, 5, 1, retInfo = True, NThreads = NThreads)
+    assert np.allclose(D, ref, rtol = 1e-12, atol = 1e-14)
+    assert Info['NIters'] == 5
+
+def test_fusion_threads_identical():
+    rng = np.random.default_rng(1)
+    Ws = [getRandomW(rng, 100, 10) for i in range(3)]
+    D1 = doSimilarityFusionWs(Ws, 10, 4, 1)
+    D2 = doSimilarityFusionWs(Ws, 10, 4, 1, NThreads = 2)
+    assert np.array_equal(D1, D2)
+
+@pytest.mark.parametrize("sparseSSM", [False, True])
+def test_ps_blocks_match_full_matrix(sparseSSM):
+    rng = np.random.default_rng(2)
+    (M, N, K) = (40, 55, 10)
+    WSSMA = getRandomW(rng, M, 8)
+    WSSMB = getRandomW(rng, N, 8)
+    if sparseSSM:
+        WSSMA = sparsifyW(WSSMA, 15, dtype = np.float64)
+        WSSMB = sparsifyW(WSSMB, 15, dtype = np.float64)
+    WCSMAB = getWCSM(rng.random((M, N)), 4, 5)
+    W = setupWCSMSSM(WSSMA, WSSMB, WCSMAB)
+    (P, S) = getPSBlocks(WSSMA, WSSMB, WCSMAB, K)
+    assert np.allclose(P, getP(W), rtol = 1e-12, atol = 1e-15)
+    assert np.allclose(S.toarray(), getS(W, K).toarray(), rtol = 1e-12, atol = 1e-15)
+    #The SSM neighbors can be computed once per song and passed in
+    (P2, S2) = getPSBlocks(WSSMA, WSSMB, WCSMAB, K, getSSMNeighbors(WSSMA, K), getSSMNeighbors(WSSMB, K))
+    assert np.array_equal(P, P2)
+    assert np.array_equal(S.toarray(), S2.toarray())